@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+tek_plot decimation modes: time of min/max envelope decimation against
+plain striding, and whether a single-sample glitch survives decimation to
+~1e5 points.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from measurement_tools.scripts import tek_plot
+
+
+def best_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=float, nargs='+',
+                        default=[1e6, 1e7, 1e8],
+                        help='Numbers of samples. Default 1e6 1e7 1e8.')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    for size in args.sizes:
+        n = int(size)
+        x = rng.normal(0, 0.01, n)
+        glitch = rng.integers(n)
+        x[glitch] = 1.  # one sample glitch
+        d = int(np.ceil(n / tek_plot.MAX_POINTS))
+        stride_s = best_time(lambda: x[::d].copy(), args.repeat)
+        env_s = best_time(lambda: tek_plot.envelope(x, 2 * d), args.repeat)
+        seen_stride = x[::d].max() > .5
+        seen_env = tek_plot.envelope(x, 2 * d).max() > .5
+        print(f'{n:.0e} samples -> ~{tek_plot.MAX_POINTS:.0e} points: '
+              f'stride {stride_s * 1e3:.1f} ms (glitch '
+              f'{"kept" if seen_stride else "lost"}), envelope '
+              f'{env_s * 1e3:.1f} ms ({n / env_s / 1e6:.0f} Msamples/s, '
+              f'glitch {"kept" if seen_env else "lost"})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Instrument discovery against stand-ins: an mDNS responder advertising an
+LXI instrument on loopback, and a ResourceManager whose scan takes
+--visa_time seconds. Checks that the stand-in instrument is discovered, and
+times a cold (scanning) and warm (cached) `discovery.list_resources`.
+
+Exits with an error if the instrument is not found, or if a cold scan takes
+noticeably longer than the VISA scan alone (discovery must not add to it,
+beyond the discovery.MDNS_QUIET s mDNS browsing needs at least).
+"""
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import time
+
+from zeroconf import IPVersion, ServiceInfo, Zeroconf
+
+from measurement_tools import discovery
+
+ADDRESS = '127.0.0.1'
+PORT = 5025
+
+
+class StandInRM:
+    """
+    `list_resources()` of a pyvisa ResourceManager, taking `scan_time` s.
+    """
+
+    def __init__(self, scan_time):
+        self.scan_time = scan_time
+        self.scans = 0
+
+    def list_resources(self):
+        self.scans += 1
+        time.sleep(self.scan_time)
+        return ('USB0::0x1313::0x8078::P0000001::INSTR',)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--visa_time', type=float, default=.5,
+                        help='Duration of the stand-in VISA scan in s.')
+    parser.add_argument('--timeout', type=float, default=1.,
+                        help='Max mDNS browse time in s.')
+    args = parser.parse_args()
+
+    responder = Zeroconf(interfaces=[ADDRESS], ip_version=IPVersion.V4Only)
+    browser = Zeroconf(interfaces=[ADDRESS], ip_version=IPVersion.V4Only)
+    info = ServiceInfo('_lxi._tcp.local.',
+                       'Stand-in E5062A._lxi._tcp.local.',
+                       addresses=[socket.inet_aton(ADDRESS)], port=PORT,
+                       server='stand-in.local.')
+    responder.register_service(info)
+    expected = discovery.MDNS_SERVICES['_lxi._tcp.local.'].format(
+        address=ADDRESS, port=PORT)
+    rm = StandInRM(args.visa_time)
+    failures = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_file = os.path.join(tmp, 'discovery')
+            timings = {}
+            for name in ['cold', 'warm']:
+                start = time.perf_counter()
+                found = discovery.list_resources(
+                    rm, cache_file=cache_file, zc=browser,
+                    timeout=args.timeout, hosts=[])
+                timings[name] = time.perf_counter() - start
+                print(f'{name}: {timings[name] * 1e3:.1f} ms, found {found}')
+            if expected not in found:
+                failures.append(f'{expected} was not discovered')
+            if rm.scans != 1:
+                failures.append(f'{rm.scans} VISA scans instead of 1')
+            # browsing stops MDNS_QUIET s after the last answer.
+            if timings['cold'] > max(args.visa_time,
+                                     discovery.MDNS_QUIET) + .2:
+                failures.append(
+                    f'cold discovery took {timings["cold"]:.2f} s, the VISA '
+                    f'scan alone {args.visa_time:.2f} s')
+            if timings['warm'] > .05:
+                failures.append(f'warm discovery took {timings["warm"]:.3f} s')
+    finally:
+        responder.unregister_service(info)
+        responder.close()
+        browser.close()
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Import-time benchmark of the package and its entry points.
+
+Each module is imported in a fresh interpreter with `python -X importtime`.
+Prints the cumulative import time, and exits non-zero if a module imports
+an instrument/analysis library it should not need at startup, or takes
+longer than its budget. The heavy imports are also checked by
+tests/test_imports.py; the wall-clock budgets only here, since they depend
+on the machine.
+"""
+import argparse
+import subprocess
+import sys
+
+# Libraries that are slow to import.
+HEAVY = ['pyvisa', 'pymeasure', 'ThorlabsPM100', 'tekscope', 'skrf',
+         'pandas', 'matplotlib', 'zeroconf']
+
+# module -> (heavy libraries it may import, budget in ms)
+MODULES = {
+    'measurement_tools': ([], 50),
+    'measurement_tools.scripts.pyvisa_list': ([], 100),
+    'measurement_tools.scripts.tek_plot': (['matplotlib'], 1000),
+    'measurement_tools.scripts.tek_control': ([], 300),
+    'measurement_tools.scripts.laser_control': ([], 300),
+    'measurement_tools.scripts.agilent33500b_control': ([], 300),
+    'measurement_tools.scripts.instrument_server': ([], 300),
+    'measurement_tools.scripts.laser_PIV': (
+        ['pyvisa', 'pymeasure', 'pandas'], 2000),
+}
+
+
+def import_times(module):
+    """
+    {top-level package: cumulative import time in ms} of everything
+    imported by `import module`.
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           f'import {module}'],
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise ImportError(proc.stderr.strip().splitlines()[-1])
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue  # header
+        name = name.strip()
+        times[name] = max(times.get(name, 0), int(cumulative) / 1e3)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scale', type=float, default=1.,
+                        help='Multiply all time budgets, for slow machines.')
+    parser.add_argument('modules', nargs='*', default=list(MODULES),
+                        help='Modules to check. Default: all entry points.')
+    args = parser.parse_args()
+    failed = False
+    for module in args.modules:
+        allowed, budget = MODULES.get(module, ([], float('inf')))
+        budget *= args.scale
+        try:
+            times = import_times(module)
+        except ImportError as e:
+            print(f'{module}: FAILED to import ({e})')
+            failed = True
+            continue
+        heavy = [m for m in HEAVY if m in times and m not in allowed]
+        total = times[module]
+        ok = len(heavy) == 0 and total <= budget
+        failed |= not ok
+        print(f'{module}: {total:.1f} ms (budget {budget:.0f} ms)'
+              + ('' if ok else ' FAILED'))
+        for m in heavy:
+            print(f'    imports {m} ({times[m]:.1f} ms)')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Compare the cost of adding one laser run (3 columns) to a results
+spreadsheet that already holds N laser runs, with the default (full
+rewrite) and incremental `add_to_spreadsheet` modes.
+
+The incremental time should stay flat as N grows.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from measurement_tools import spreadsheet
+
+
+def run_df(laserid, npoints):
+    currents = np.arange(npoints)
+    return pd.DataFrame({f'{laserid}_mA': currents,
+                         f'{laserid}_V': np.random.rand(npoints),
+                         f'{laserid}_mW': np.random.rand(npoints)})
+
+
+def bench(fname, nruns, npoints, incremental):
+    base = pd.concat([run_df(f'laser{k}', npoints) for k in range(nruns)],
+                     axis=1)
+    spreadsheet.write_spreadsheet(fname, base)
+    start = time.perf_counter()
+    spreadsheet.add_to_spreadsheet(fname, run_df('new', npoints),
+                                   incremental=incremental)
+    elapsed = time.perf_counter() - start
+    spreadsheet.remove_parts(fname)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--nruns', type=int, nargs='+',
+                        default=[10, 50, 100, 200])
+    parser.add_argument('--npoints', type=int, default=200)
+    parser.add_argument('--extension', default='.xlsx',
+                        choices=['.xlsx', '.csv'])
+    args = parser.parse_args()
+    print(f'{"runs in file":>12} {"full [s]":>10} {"incremental [s]":>16}')
+    with tempfile.TemporaryDirectory() as d:
+        fname = os.path.join(d, 'results' + args.extension)
+        for nruns in args.nruns:
+            full = bench(fname, nruns, args.npoints, incremental=False)
+            incr = bench(fname, nruns, args.npoints, incremental=True)
+            print(f'{nruns:>12} {full:>10.4f} {incr:>16.4f}')
+
+
+if __name__ == '__main__':
+    main()
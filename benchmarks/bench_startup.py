@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Compare instrument startup cost with a fresh pyvisa ResourceManager per
+instrument (the old behaviour of the wrappers factories) against the shared
+ResourceManager in measurement_tools.resources.
+
+Without arguments, only the ResourceManager creation + resource scan is
+timed. Pass resource names (see pyvisa_list) to also time opening them.
+"""
+import argparse
+import time
+
+import pyvisa
+
+from measurement_tools import resources
+
+
+def fresh(names, ninstruments):
+    for k in range(ninstruments):
+        rm = pyvisa.ResourceManager()
+        rm.list_resources()
+        for name in names:
+            rm.open_resource(name).close()
+        rm.close()
+
+
+def shared(names, ninstruments):
+    for k in range(ninstruments):
+        rm = resources.resource_manager()
+        rm.list_resources()
+        for name in names:
+            resources.open_resource(name)
+    resources.close_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('names', nargs='*', help='VISA resource names')
+    parser.add_argument('--ninstruments', '-n', type=int, default=4,
+                        help='Number of factory calls to simulate.')
+    args = parser.parse_args()
+    for label, fn in [('fresh ResourceManager per instrument', fresh),
+                      ('shared ResourceManager + pool', shared)]:
+        start = time.perf_counter()
+        fn(args.names, args.ninstruments)
+        print(f'{label}: {time.perf_counter() - start:.3f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Waveform transfer throughput: binary CURVe? decoded straight into numpy
+(measurement_tools.tek) against an ASCII CURVe? parsed through python
+lists (the way the tekscope waveforms are turned into arrays).
+
+Without --host, a stand-in scope serving random data over a socketpair is
+used, which measures the decoding cost on this machine. With --host, the
+real scope's current record is transferred.
+"""
+import argparse
+import socket
+import threading
+import time
+
+import numpy as np
+
+from measurement_tools import tek
+
+
+class StandInScope:
+    """
+    Answers the SCPI commands `tek` sends, over one end of a socketpair.
+    """
+
+    def __init__(self, npoints):
+        self.soc, self.peer = socket.socketpair()
+        self.npoints = npoints
+        self.encoding = 'RIBINARY'
+        self.nbytes = 1
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        buf = b''
+        while True:
+            chunk = self.peer.recv(4096)
+            if len(chunk) == 0:
+                return
+            buf += chunk
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                self.handle(line.decode('ascii').strip())
+
+    def handle(self, command):
+        upper = command.upper()
+        if upper.startswith('DATA:ENCDG'):
+            self.encoding = upper.split()[1]
+        elif upper.startswith('WFMOUTPRE:BYT_NR '):
+            self.nbytes = int(upper.split()[1])
+        elif upper == 'HORIZONTAL:RECORDLENGTH?':
+            self.send(f'{self.npoints}\n'.encode())
+        elif upper.startswith('SELECT:'):
+            self.send(b'1\n')
+        elif upper.startswith('WFMOUTPRE:BYT_NR?'):
+            self.send(f'{self.nbytes};1.0E-8;-1.0E-3;4.0E-2;0.0;0.0\n'
+                      .encode())
+        elif upper == 'CURVE?':
+            dtype = np.int8 if self.nbytes == 1 else np.dtype('>i2')
+            codes = np.random.randint(-100, 100, self.npoints).astype(dtype)
+            if self.encoding.startswith('ASC'):
+                self.send(','.join(map(str, codes)).encode() + b'\n')
+            else:
+                data = codes.tobytes()
+                length = str(len(data)).encode()
+                self.send(b'#' + str(len(length)).encode() + length + data
+                          + b'\n')
+
+    def send(self, data):
+        self.peer.sendall(data)
+
+
+class Scope:
+    def __init__(self, host, port):
+        self.soc = socket.create_connection((host, port))
+
+
+def ascii_transfer(scope, source):
+    tek.write(scope, 'DATa:ENCdg ASCii')
+    tek.write(scope, f'DATa:SOUrce {source}')
+    tek.write(scope, 'CURVe?')
+    line = tek.read_line(scope).decode('ascii')
+    return np.array([float(v) for v in line.split(',')])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', help='Scope address. Default: stand-in.')
+    parser.add_argument('--port', type=int, default=4000,
+                        help='Scope socket server port. Default 4000.')
+    parser.add_argument('--source', default='CH1')
+    parser.add_argument('--npoints', type=int, default=1_000_000,
+                        help='Record length of the stand-in scope.')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    scope = StandInScope(args.npoints) if args.host is None else \
+        Scope(args.host, args.port)
+
+    for nbytes in (1, 2):
+        tek.setup_binary_transfer(scope, nbytes)
+        wfm = tek.retrieve_waveform(scope, args.source)
+        out = wfm.codes  # reuse the buffer, like repeated captures would
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            wfm = tek.retrieve_waveform(scope, args.source, out=out)
+        dt = (time.perf_counter() - start) / args.repeat
+        mb = wfm.codes.nbytes / 1e6
+        print(f'binary, {nbytes} byte(s)/sample: {len(wfm)} points in '
+              f'{dt * 1e3:.1f} ms, {mb / dt:.1f} MB/s, '
+              f'{len(wfm) / dt / 1e6:.1f} Msamples/s')
+
+    start = time.perf_counter()
+    v = ascii_transfer(scope, args.source)
+    dt = time.perf_counter() - start
+    print(f'ASCII: {len(v)} points in {dt * 1e3:.1f} ms, '
+          f'{len(v) / dt / 1e6:.1f} Msamples/s')
+    tek.write(scope, 'DATa:ENCdg RIBinary')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Peak memory (RSS) and time of tek_plot's chunked processing of .mtw files
+of 1e6-1e9 samples, against loading the whole capture into memory the way
+tek_plot used to (only up to --legacy_max samples, it needs 16 bytes per
+sample).
+
+Each measurement runs in a fresh python process (Linux only: peak RSS is
+read from /proc). The test files are written to --dir (1 byte per sample,
+~1 GB for 1e9 samples) and deleted afterwards.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from measurement_tools import tek, waveform_file
+
+# Peak RSS is read from VmHWM: ru_maxrss would include the RSS of this
+# (parent) process at fork time, which is large after writing a test file.
+CHILD = '''
+import sys, time
+import numpy as np
+from measurement_tools import waveform_file
+from measurement_tools.scripts import tek_plot
+fname, mode, medfilt = sys.argv[1], sys.argv[2], int(sys.argv[3])
+start = time.perf_counter()
+if mode == 'chunked':
+    wfms = waveform_file.open_waveforms(fname)
+    d = max(int(np.ceil(len(wfms) / tek_plot.MAX_POINTS)), 1)
+    t, v = tek_plot.process(wfms, medfilt, d)
+else:
+    arr = waveform_file.load_array(fname)
+    d = max(int(np.ceil(arr.shape[-1] / tek_plot.MAX_POINTS)), 1)
+    if medfilt != -1:
+        arr = np.vstack((arr[0, (medfilt - 1) // 2:-(medfilt // 2)],
+                         np.convolve(arr[1], np.ones(medfilt), 'valid')
+                         / medfilt))
+    arr = arr[:, ::d]
+with open('/proc/self/status') as f:
+    hwm = f.read().split('VmHWM:')[1].split()[0]
+print(time.perf_counter() - start, hwm)
+'''
+
+
+def make_file(fname, nsamples, chunk=1 << 24):
+    """
+    Single channel .mtw file of random int8 codes, written in chunks.
+    """
+    raw = fname + '.raw'
+    codes = np.memmap(raw, dtype=np.int8, mode='w+', shape=(nsamples,))
+    rng = np.random.default_rng(0)
+    for start in range(0, nsamples, chunk):
+        stop = min(start + chunk, nsamples)
+        codes[start:stop] = rng.integers(-100, 100, stop - start,
+                                         dtype=np.int8)
+    codes.flush()
+    wfm = tek.Waveform(codes, -1e-3, 1e-9, 4e-2, 0., 0., source='CH1')
+    waveform_file.write_waveforms(fname, [wfm])
+    del codes, wfm
+    os.remove(raw)
+
+
+def measure(fname, mode, medfilt):
+    out = subprocess.run([sys.executable, '-c', CHILD, fname, mode,
+                          str(medfilt)],
+                         capture_output=True, text=True, check=True).stdout
+    seconds, hwm_kb = out.split()
+    return float(seconds), int(hwm_kb) / 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=float, nargs='+',
+                        default=[1e6, 1e7, 1e8, 1e9],
+                        help='Numbers of samples. Default 1e6 1e7 1e8 1e9.')
+    parser.add_argument('--medfilt', type=int, default=-1,
+                        help='Moving average width, as tek_plot -m.')
+    parser.add_argument('--legacy_max', type=float, default=1e8,
+                        help='''Largest file to also load fully in memory.
+                        Default 1e8.''')
+    parser.add_argument('--dir', default=None,
+                        help='Directory for the test files. Default: tmp.')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for size in args.sizes:
+            nsamples = int(size)
+            fname = os.path.join(tmp, f'{nsamples}.mtw')
+            make_file(fname, nsamples)
+            modes = ['chunked'] + \
+                (['in memory'] if nsamples <= args.legacy_max else [])
+            for mode in modes:
+                seconds, rss_mb = measure(fname, mode, args.medfilt)
+                print(f'{nsamples:.0e} samples, {mode}: {seconds:.2f} s, '
+                      f'peak RSS {rss_mb:.0f} MB')
+            os.remove(fname)
+
+
+if __name__ == '__main__':
+    main()
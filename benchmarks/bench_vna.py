@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Time VNA transfers against a connected AgilentE5062A. Assumes the sweep
+settings (and calibration) have been set.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from measurement_tools import AgilentE5062AVNA
+from measurement_tools import vna as vna_utils
+
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return np.mean(times), np.std(times)
+
+
+def bench_construct_network(vna, repeat):
+    ch = vna.channels[1]
+    vna_utils.init_measurement(vna)
+    slow, slow_std = timeit(
+        lambda: vna_utils.construct_network(ch, fast=False), repeat)
+    fast, fast_std = timeit(
+        lambda: vna_utils.construct_network(ch, fast=True), repeat)
+    print(f'construct_network ({ch.scan_points} points, {repeat} calls)')
+    print(f'  per-trace ASCII: {slow:.3f} +/- {slow_std:.3f} s')
+    print(f'  bulk binary:     {fast:.3f} +/- {fast_std:.3f} s')
+    print(f'  saved per call:  {slow - fast:.3f} s')
+
+
+def bench_averaging(vna, averagings, repeat, outdir):
+    fname = os.path.join(outdir, 'bench.s2p')
+    print(f'{"averaging":>9} {"python loop [s]":>16} '
+          f'{"averaging trigger [s]":>22}')
+    for averaging in averagings:
+        loop, _ = timeit(lambda: vna_utils.measure_and_save_touchstone(
+            vna, fname, averaging=averaging), repeat)
+        trig, _ = timeit(lambda: vna_utils.measure_and_save_touchstone(
+            vna, fname, averaging=averaging, averaging_trigger=True), repeat)
+        print(f'{averaging:>9} {loop:>16.3f} {trig:>22.3f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--averaging', type=int, nargs='+',
+                        default=[1, 10, 100])
+    args = parser.parse_args()
+    vna = AgilentE5062AVNA()
+    bench_construct_network(vna, args.repeat)
+    with tempfile.TemporaryDirectory() as d:
+        bench_averaging(vna, args.averaging, 1, d)
+
+
+if __name__ == '__main__':
+    main()
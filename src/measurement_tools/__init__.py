@@ -1,14 +1,45 @@
 """
 Alec Vercruysse
 2023-06-27
+
+The instrument classes, factories and submodules are imported on first
+access (PEP 562), so e.g. `pyvisa_list` or `tek_plot` don't pay for
+importing pyvisa, pymeasure, skrf, ... at startup. `benchmarks/bench_import.py`
+checks that it stays that way.
 """
+import importlib
+
+# attribute -> submodule defining it
+_LAZY_ATTRIBUTES = {
+    'LaserDriver': 'arroyo',
+    'OpticalPowerMeter': 'wrappers',
+    'Agilent33500BFnGen': 'wrappers',
+    'AgilentE5062AVNA': 'wrappers',
+    'TekScope': 'wrappers',
+    'PSMU': 'wrappers',
+}
+
+_SUBMODULES = [
+    'acquisition', 'arroyo', 'caching', 'database', 'discovery', 'interact',
+    'log_utils', 'resources', 'results', 'server', 'spreadsheet', 'tek',
+    'vna', 'waveform_file', 'wrappers',
+]
+
+__all__ = list(_LAZY_ATTRIBUTES) + _SUBMODULES
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        module = importlib.import_module(
+            f'.{_LAZY_ATTRIBUTES[name]}', __name__)
+        value = getattr(module, name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module(f'.{name}', __name__)
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    globals()[name] = value  # only look it up once
+    return value
+
 
-from .arroyo import LaserDriver
-from .wrappers import (
-    OpticalPowerMeter,
-    Agilent33500BFnGen,
-    AgilentE5062AVNA,
-    TekScope,
-    PSMU,
-)
-from . import log_utils
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
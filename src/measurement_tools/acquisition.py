@@ -0,0 +1,192 @@
+"""
+Helpers to take measurements from instruments efficiently, e.g. waiting only
+as long as needed for a reading to settle instead of a fixed sleep.
+"""
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+SettleResult = namedtuple(
+    'SettleResult',
+    ['mean', 'std', 'settle_time', 'nsamples', 'converged'])
+SettleResult.__doc__ = """
+mean, std: of the last `window` samples.
+settle_time: seconds from the first read until convergence (or timeout).
+nsamples: total number of reads.
+converged: False if the timeout was hit.
+"""
+
+# Duration of one PM100D sample (SENSe:AVERage:COUNt counts these), in s.
+PM100_SAMPLE_TIME = 3e-3
+
+
+def settle(read, criterion='stderr', tol=0., rel_tol=1e-3, window=10,
+           timeout=5., interval=0.):
+    """
+    Stream readings from `read()` until the last `window` of them satisfy
+    a convergence test, or until `timeout` seconds have passed.
+
+    Parameters:
+    ----------
+    read: callable returning a float, e.g. `lambda: p.read` or
+      `laser_driver.get_voltage`.
+    criterion: 'stderr': standard error of the mean of the window, or
+      'slope': drift over the window (least squares slope * window duration).
+    tol, rel_tol: converged when the criterion is at most
+      max(tol, rel_tol * |mean|), in the units of `read()`. Readings near
+      zero only converge with tol > 0 (e.g. the instrument noise floor).
+    window: number of samples the test (and the returned mean) uses.
+    timeout: seconds. The result is returned (converged=False) on timeout.
+    interval: seconds to sleep between reads (0 reads back to back, as fast
+      as the instrument answers).
+
+    Returns:
+    -------
+    SettleResult
+    """
+    if criterion not in ('stderr', 'slope'):
+        raise ValueError(f'Unknown settling criterion: {criterion}')
+    if window < 2:
+        raise ValueError('Need a window of at least 2 samples to settle.')
+    ts, vs = deque(maxlen=window), deque(maxlen=window)
+    start = time.perf_counter()
+    n = 0
+    while True:
+        vs.append(read())
+        now = time.perf_counter()
+        ts.append(now)
+        n += 1
+        if len(vs) == window:
+            v = np.array(vs)
+            mean = v.mean()
+            if criterion == 'stderr':
+                metric = v.std(ddof=1) / np.sqrt(window)
+            else:
+                t = np.array(ts) - ts[0]
+                slope = np.polyfit(t, v, 1)[0] if t[-1] > 0 else 0.
+                metric = abs(slope) * t[-1]
+            converged = metric <= max(tol, rel_tol * abs(mean))
+            if converged or now - start > timeout:
+                return SettleResult(mean, v.std(ddof=1), now - start,
+                                    n, converged)
+        elif now - start > timeout:
+            v = np.array(vs)
+            return SettleResult(v.mean(), np.nan, now - start, n, False)
+        if interval > 0:
+            time.sleep(interval)
+
+
+PowerMeasurement = namedtuple(
+    'PowerMeasurement', ['mean', 'std', 'tint', 'nsamples', 'wall_time'])
+PowerMeasurement.__doc__ = """
+mean: average power in W.
+std: estimated standard deviation of a single power meter sample, in W.
+  NaN if it could not be estimated: in hardware mode that needs
+  nrepeat > 1, since one hardware-averaged reading has no spread.
+tint: the power meter's integration time, in s (nsamples *
+  PM100_SAMPLE_TIME).
+nsamples: number of power meter samples averaged.
+wall_time: time spent measuring, in s (including the bus round trips).
+"""
+
+
+def set_power_averaging(p, nsamples):
+    """
+    Make a ThorlabsPM100 (see `wrappers.OpticalPowerMeter`) average
+    `nsamples` samples per reading on the instrument. Call once before
+    `measure_power(..., hardware=True)`.
+
+    Returns:
+    -------
+    The previous averaging count, to restore it with when done.
+    """
+    previous = p.sense.average.count
+    p.sense.average.count = nsamples
+    return previous
+
+
+def measure_power(p, nsamples, hardware=True, nrepeat=1):
+    """
+    Measure the average of `nsamples` power meter samples.
+
+    Parameters:
+    ----------
+    p: ThorlabsPM100 object.
+    nsamples: number of samples to average.
+    hardware: if True, the power meter averages (`set_power_averaging`
+      must have been called with the same `nsamples`) and a single READ?
+      (trigger + fetch) is sent. Otherwise, read `nsamples` times and
+      average in python (one USBTMC round trip per sample; the averaging
+      count must be 1).
+    nrepeat: hardware mode only. Number of hardware-averaged readings to
+      take. The sample std can only be estimated (from their spread) with
+      nrepeat > 1.
+
+    Returns:
+    -------
+    PowerMeasurement
+    """
+    start = time.perf_counter()
+    if hardware:
+        v = np.array([p.read for _ in range(nrepeat)])
+        wall_time = time.perf_counter() - start
+        std = v.std(ddof=1) * np.sqrt(nsamples) if nrepeat > 1 else np.nan
+        n = nsamples * nrepeat
+        return PowerMeasurement(v.mean(), std, n * PM100_SAMPLE_TIME, n,
+                                wall_time)
+    v = np.array([p.read for _ in range(nsamples)])
+    wall_time = time.perf_counter() - start
+    std = v.std(ddof=1) if nsamples > 1 else np.nan
+    return PowerMeasurement(v.mean(), std, nsamples * PM100_SAMPLE_TIME,
+                            nsamples, wall_time)
+
+
+def sample_concurrently(readers, nsamples):
+    """
+    Sample several instruments at the same time, one thread per instrument.
+    The threads start each sample together (a barrier), so that sample k of
+    every instrument is taken at (nearly) the same moment, and one sample
+    period costs as long as the slowest instrument, not the sum of all of
+    them. Only use this for instruments on independent buses.
+
+    Parameters:
+    ----------
+    readers: dict {name: callable returning a float}.
+    nsamples: number of samples per instrument.
+
+    Returns:
+    -------
+    (values, times): dicts {name: np.array of shape (nsamples,)}, where
+    times are the perf_counter midpoints of each read, so the k-th values
+    of all instruments are time-aligned pairs.
+    """
+    names = list(readers)
+    values = {name: np.empty(nsamples) for name in names}
+    times = {name: np.empty(nsamples) for name in names}
+    barrier = threading.Barrier(len(names))
+
+    def worker(name):
+        read = readers[name]
+        try:
+            for k in range(nsamples):
+                barrier.wait()
+                start = time.perf_counter()
+                values[name][k] = read()
+                times[name][k] = (start + time.perf_counter()) / 2
+        except BaseException:
+            barrier.abort()  # don't leave the other threads waiting
+            raise
+
+    with ThreadPoolExecutor(max_workers=len(names)) as pool:
+        futures = [pool.submit(worker, name) for name in names]
+        errors = [f.exception() for f in futures]
+    # report the original error rather than the BrokenBarrierErrors it
+    # caused in the other threads.
+    errors = [e for e in errors if e is not None]
+    errors.sort(key=lambda e: isinstance(e, threading.BrokenBarrierError))
+    if errors:
+        raise errors[0]
+    return values, times
@@ -15,101 +15,179 @@ TODO:
 Consider refactoring so that gettable and settable things
 are properties rather than methods.
 """
-from datetime import datetime, timedelta
 import time
 import threading
 import atexit
+import re
 import sys
+from collections import deque, namedtuple
 
 import pyvisa
 from pyvisa import constants
 
-from measurement_tools import interact
+from measurement_tools import interact, resources
+
+WaitStats = namedtuple('WaitStats',
+                       ['conditions', 'polls', 'elapsed', 'success'])
+WaitStats.__doc__ = """
+conditions: {condition name: target state} that was waited for.
+polls: number of LASER:COND? queries sent.
+elapsed: seconds from the start of the wait until the conditions were met
+  (or the timeout).
+success: False if the wait timed out.
+"""
 
 
 class LaserDriver:
-    def __init__(self, rm, Io_max=None, Vf_max=None, name=None):
+    # Bits of the Laser Condition Status Register (LASER:COND?) that
+    # `_wait_until_condition` can wait for, by name.
+    COND_BITS = {
+        'current_limit': 0,
+        'voltage_limit': 1,
+        'interlock_error': 4,
+        'open_circuit': 7,
+        'output_shorted': 8,
+        'laser_output': 10,
+    }
+    # Bits of the Laser Event Status Register (LASER:EVENT?) the watchdog
+    # reports.
+    EVENT_BITS = {
+        0: 'Current Limit',
+        1: 'Voltage Limit',
+        4: 'Interlock Error',
+        7: 'Open Circuit',
+        8: 'Output Shorted',
+    }
+
+    def __init__(self, rm=None, Io_max=None, Vf_max=None, name=None):
         """
         Prompts interactively if name is not provided.
+        rm: pyvisa ResourceManager. Defaults to the shared one (see
+          measurement_tools.resources).
         Io_max: maximum forward current in mA
         Vf_max: maximum forward voltage in Volts.
         """
-        self.rm = rm
+        self.rm = rm if rm is not None else resources.resource_manager()
         self.idn = None
         if name is None:
             print('Connecting to Laser Driver:')
-            name = interact.get_pyvisa_instr_ID(rm, mytype='LaserDriver')
-        self.name = name
-        self.instr = self.rm.open_resource(self.name)
-        self.instr.baud_rate = 38400
-        self.instr.timeout = 500
-        self.instr.write_termination = '\n'
-        self.instr.send_end = True
-        self.instr.data_bits = 8
-        self.instr.stop_bits = constants.StopBits['one']
-        self.instr.parity = constants.Parity['none']
-        try:
-            self.idn = self.instr.query('*IDN?')
-        except pyvisa.errors.VisaIOError:
-            # Weirdly, it errors out once and works the second time.
-            self.idn = self.instr.query('*IDN?')
-            print("\nClear any errors that appear on the " +
-                  "Laser Driver Screen and disregard!!!!")
+        self.instr, self.name = interact.connect_instr(
+            self.rm, 'LaserDriver', self._connect, name=name,
+            disconnect=lambda instr: instr.close())
         print(f'Successfully connected to {self.idn}')
         self.instr_lock = threading.Lock()
         self.error = False
+        # LASER:COND? polling of `_wait_until_condition`: the interval (s)
+        # starts at poll_interval and is multiplied by poll_backoff after
+        # every poll, up to max_poll_interval.
+        self.poll_interval = 2e-3
+        self.max_poll_interval = 50e-3
+        self.poll_backoff = 2.
+        self.wait_stats = deque(maxlen=100)  # WaitStats of recent waits
+        # Every query also reads LASER:EVENT? (see `query_val`). The
+        # watchdog only polls it when there was no such query for
+        # watchdog_interval seconds.
+        self.watchdog_interval = 0.25
+        # clear event register (e.g. from prev. run)
+        self._query_values('LASER:EVENT?')
+        self._last_event_check = time.perf_counter()
+        self._stop_watchdog = threading.Event()
         self.watchdog = threading.Thread(target=self._laser_error_watchdog,
                                          daemon=True)
         self.watchdog.start()
         atexit.register(self.close)
+        self.resync_limits()
         if Io_max is not None:
             self.set_current_limit(Io_max)
         if Vf_max is not None:
             self.set_voltage_limit(Vf_max)
 
+    def _connect(self, name):
+        """
+        Open and configure the serial port `name`, and query *IDN?.
+        """
+        instr = self.rm.open_resource(name)
+        try:
+            instr.baud_rate = 38400
+            instr.timeout = 500
+            instr.write_termination = '\n'
+            instr.send_end = True
+            instr.data_bits = 8
+            instr.stop_bits = constants.StopBits['one']
+            instr.parity = constants.Parity['none']
+            try:
+                self.idn = instr.query('*IDN?')
+            except pyvisa.errors.VisaIOError:
+                # Weirdly, it errors out once and works the second time.
+                self.idn = instr.query('*IDN?')
+                print("\nClear any errors that appear on the " +
+                      "Laser Driver Screen and disregard!!!!")
+        except Exception:
+            instr.close()
+            raise
+        return instr, self.idn
+
+    def resync_limits(self):
+        """
+        Read the current and voltage limits from the driver into
+        `current_limit` (mA) and `voltage_limit` (V). They are kept up to
+        date by `set_current_limit` and `set_voltage_limit`; call this if
+        they were changed otherwise (e.g. on the front panel).
+        """
+        with self.instr_lock:
+            self.current_limit = self.query_val('LASER:LIMIT:LDI?')
+            self.voltage_limit = self.query_val('LASER:LIMIT:LDV?')
+
     def set_current_limit(self, limit, confirm=True):
         """
         in mA.
         """
-        if confirm:
-            with self.instr_lock:
-                old_limit = self.query_reg('LASER:LIMIT:LDI?')
-            if limit > old_limit:
-                response = interact.confirm(
-                    f'Raise Laser Io limit from {old_limit} to {limit} mA?')
-                if not response:
-                    return
+        if confirm and limit > self.current_limit:
+            response = interact.confirm(
+                f'Raise Laser Io limit from {self.current_limit} to '
+                f'{limit} mA?')
+            if not response:
+                return
         with self.instr_lock:
-            self.instr.write('LASER:LIMIT:LDI ' + str(limit))
-        print(f'Set Laser Io limit to {limit} mA.')
+            # read back the limit as the driver applied it.
+            self.current_limit = self.query_val(
+                f'LASER:LIMIT:LDI {limit};LASER:LIMIT:LDI?')
+        print(f'Set Laser Io limit to {self.current_limit} mA.')
 
     def set_voltage_limit(self, limit, confirm=True):
         """
         in V.
         """
-        if confirm:
-            with self.instr_lock:
-                # pdb.set_trace()
-                old_limit = self.query_val('LASER:LIMIT:LDV?')
-            if limit > old_limit:
-                response = interact.confirm(
-                    f'Raise Laser Vf limit from {old_limit} to {limit} V?')
-                if not response:
-                    return
+        if confirm and limit > self.voltage_limit:
+            response = interact.confirm(
+                f'Raise Laser Vf limit from {self.voltage_limit} to '
+                f'{limit} V?')
+            if not response:
+                return
         with self.instr_lock:
-            self.instr.write('LASER:LIMIT:LDV ' + str(limit))
-        print(f'Set Laser Vf limit to {limit} V.')
+            self.voltage_limit = self.query_val(
+                f'LASER:LIMIT:LDV {limit};LASER:LIMIT:LDV?')
+        print(f'Set Laser Vf limit to {self.voltage_limit} V.')
 
     def set_output_current(self, mA):
         '''
-        Set output current in mA.
+        Set output current in mA. Checked against the cached current limit.
         '''
-        with self.instr_lock:
-            I_max = self.query_reg('LASER:LIMIT:LDI?')
-        assert mA <= I_max
+        assert mA <= self.current_limit
         with self.instr_lock:
             self.instr.write("LASER:LDI " + str(mA))
 
+    def set_output_current_and_measure(self, mA):
+        '''
+        Set output current in mA and return the measured voltage in V, in a
+        single transaction (LASER:LDI <mA>;LASER:LDV?). Note the voltage is
+        measured right away, without waiting for the laser to settle.
+        '''
+        assert mA <= self.current_limit
+        with self.instr_lock:
+            retval = self.query_val(f'LASER:LDI {mA};LASER:LDV?')
+        return retval
+
     def get_voltage(self):
         '''
         Get the measured voltage in V
@@ -143,53 +221,98 @@ class LaserDriver:
     def query_val(self, query):
         """
         Need to aquire a lock first!
+        The laser event register is read in the same transaction
+        (`<query>;LASER:EVENT?`) and checked for errors, so regular traffic
+        doubles as the error watchdog.
+        """
+        if query.upper() != 'LASER:EVENT?':
+            query += ';LASER:EVENT?'
+        values = self._query_values(query)
+        self._check_events(int(values[-1]))
+        return values[0]
+
+    def _query_values(self, query):
+        """
+        Values of a (possibly compound) query, as floats.
+        Need to aquire a lock first!
+        """
+        response = self.instr.query(query)
+        return [float(v) for v in re.split(r'[;,]', response.strip())
+                if v.strip()]
+
+    def _check_events(self, val):
+        """
+        Report the errors flagged in a LASER:EVENT? response.
         """
-        return self.instr.query_ascii_values(query)[0]
+        self._last_event_check = time.perf_counter()
+        for bit, issue in self.EVENT_BITS.items():
+            if val & (1 << bit):
+                self.error = True
+                print(f'Watchdog: Laser {issue}!!')
 
     def _laser_error_watchdog(self):
-        laser_cond_bits = {
-            0: "Current Limit",
-            1: "Voltage Limit",
-            4: 'Interlock Error',
-            7: 'Open Circuit',
-            8: 'Output Shorted'
-        }
-        with self.instr_lock:
-            # clear error register (e.g. from prev. run)
-            self.query_reg('LASER:EVENT?')
-        while True:  # self._run_watchdog.is_set():
-            time.sleep(1)
-            with self.instr_lock:
-                val = self.query_reg('LASER:EVENT?')
-            for bit, issue in laser_cond_bits.items():
-                if val & (1 << bit):
-                    self.error = True
-                    # Exception would stop watchdog
-                    print(f'Watchdog: Laser {issue}!!')
+        """
+        Poll LASER:EVENT? while the bus is idle, until `close`.
+        """
+        while not self._stop_watchdog.wait(self.watchdog_interval):
+            if time.perf_counter() - self._last_event_check < \
+                    self.watchdog_interval:
+                continue  # checked by regular traffic
+            if not self.instr_lock.acquire(blocking=False):
+                continue  # the transaction in progress checks the events
+            try:
+                self.query_val('LASER:EVENT?')
+            finally:
+                self.instr_lock.release()
 
-    def _wait_until_condition(self, laser_output=None,
-                              timeout=5000):
+    def _wait_until_condition(self, timeout=5000, poll_interval=None,
+                              max_poll_interval=None, poll_backoff=None,
+                              **conditions):
         """
+        Poll LASER:COND? until every condition bit is in its target state,
+        e.g. `_wait_until_condition(laser_output=True)`. Condition names are
+        the keys of COND_BITS.
+
+        The lock is released between polls, and the poll interval grows
+        from `poll_interval` by `poll_backoff` up to `max_poll_interval`
+        (all in s; default to the attributes of the same name), so waiting
+        does not saturate the serial link. Every wait is recorded in
+        `self.wait_stats`.
+
         Timeout in ms.
         """
-        start = datetime.now()
-        if laser_output is not None:
-            query = 'LASER:COND?'
-            bit = 10  # Output On bit in Laser Condition Status Register
-            target = laser_output
-        else:
-            raise NotImplementedError
-        done = False
-        while not done:
+        unknown = set(conditions) - set(self.COND_BITS)
+        if len(conditions) == 0 or unknown:
+            raise ValueError(f'Unknown laser conditions: {unknown}. '
+                             f'Choose from {list(self.COND_BITS)}')
+        interval = self.poll_interval if poll_interval is None \
+            else poll_interval
+        max_interval = self.max_poll_interval if max_poll_interval is None \
+            else max_poll_interval
+        backoff = self.poll_backoff if poll_backoff is None else poll_backoff
+        mask = target = 0
+        for name, state in conditions.items():
+            mask |= 1 << self.COND_BITS[name]
+            target |= bool(state) << self.COND_BITS[name]
+        start = time.perf_counter()
+        polls = 0
+        while True:
             with self.instr_lock:
-                val = self.query_reg(query)
-            if (val & (1 << bit)) == (target << bit):
-                done = True
-            elif (datetime.now() - start) / timedelta(
-                    milliseconds=1) > timeout:
+                val = self.query_reg('LASER:COND?')
+            polls += 1
+            elapsed = time.perf_counter() - start
+            if val & mask == target:
+                self.wait_stats.append(
+                    WaitStats(conditions, polls, elapsed, True))
+                return
+            if elapsed * 1e3 > timeout:
+                self.wait_stats.append(
+                    WaitStats(conditions, polls, elapsed, False))
                 raise TimeoutError("Laser Driver timed out " +
-                                   f"waiting for condition {laser_output=}" +
-                                   f" ({query}={val})")
+                                   f"waiting for condition {conditions}" +
+                                   f" (LASER:COND?={val})")
+            time.sleep(min(interval, max(timeout / 1e3 - elapsed, 0)))
+            interval = min(interval * backoff, max_interval)
 
     def close(self):
         """
@@ -197,6 +320,8 @@ class LaserDriver:
         Registering with atexit seems to work for now.
         """
         print(f"Closing {self.name}: {self.idn}")
+        self._stop_watchdog.set()
+        self.watchdog.join()
         try:
             self.disable_output()
             with self.instr_lock:
@@ -0,0 +1,233 @@
+"""
+Shadow-state cache for pymeasure instruments.
+
+`cached(instr)` returns a proxy that remembers the last value written to
+(or read from) every settable property of the instrument and its channels,
+and drops writes that would not change that value. This saves a full SCPI
+transaction per skipped write, and avoids side effects of re-sending a
+setting (e.g. the E5062A restarts averaging when the sweep changes).
+
+The cache only knows about writes made through the proxy. It is cleared on
+*RST (`reset()` or `write('*RST')` through the proxy); call `invalidate`
+after anything else that may change the instrument state behind its back
+(front panel, raw SCPI, errors). Raw SCPI `write()`s are never skipped, so
+use them for commands that must always be sent (e.g. safety shutdowns).
+
+Within `with batch(instr):`, the writes that are not skipped are queued and
+sent as a single ';'-joined SCPI line when the block exits.
+
+The factories in `wrappers` return a proxy when called with cached=True.
+"""
+import weakref
+from contextlib import contextmanager
+
+from pymeasure.instruments import Channel, Instrument
+
+_caches = weakref.WeakKeyDictionary()
+
+
+class SettingsCache:
+    """
+    Known instrument state, keyed by (channel path..., property name), and
+    counters of sent and skipped writes.
+    """
+
+    def __init__(self):
+        self.state = {}
+        self.sent = 0
+        self.skipped = 0
+
+    def invalidate(self, prefix=(), names=()):
+        """
+        Forget the state under `prefix` (everything by default), or only
+        the given property names under it.
+        """
+        for key in list(self.state):
+            if key[:len(prefix)] != prefix:
+                continue
+            if len(names) == 0 or key[-1] in names:
+                del self.state[key]
+
+    def stats(self):
+        return {'sent': self.sent, 'skipped': self.skipped}
+
+
+class CachingProxy:
+    """
+    Stands in for an instrument (or one of its channels). Attribute access
+    is forwarded to the wrapped object. See the module docstring.
+    """
+
+    def __init__(self, obj, cache, key=()):
+        object.__setattr__(self, '_obj', obj)
+        object.__setattr__(self, '_cache', cache)
+        object.__setattr__(self, '_key', key)
+
+    def __getattr__(self, name):
+        obj = self._obj
+        value = getattr(obj, name)
+        if _is_setting(obj, name):
+            # the instrument's answer is the best knowledge of its state.
+            self._cache.state[self._key + (name,)] = value
+            return value
+        if name == 'reset':
+            return self._wrap_reset(value)
+        if name == 'write':
+            return self._wrap_write(value)
+        return _wrap(value, self._cache, self._key)
+
+    def __setattr__(self, name, value):
+        obj = self._obj
+        if not _is_setting(obj, name):
+            setattr(obj, name, value)
+            return
+        cache = self._cache
+        key = self._key + (name,)
+        if key in cache.state and _equal(cache.state[key], value):
+            cache.skipped += 1
+            return
+        try:
+            setattr(obj, name, value)
+        except BaseException:
+            cache.state.pop(key, None)  # unknown whether it took effect
+            raise
+        cache.state[key] = value
+        cache.sent += 1
+
+    def _wrap_reset(self, reset):
+        def wrapped(*args, **kwargs):
+            self._cache.invalidate()
+            return reset(*args, **kwargs)
+        return wrapped
+
+    def _wrap_write(self, write):
+        def wrapped(command, *args, **kwargs):
+            if '*RST' in command.upper():
+                self._cache.invalidate()
+            return write(command, *args, **kwargs)
+        return wrapped
+
+    def __dir__(self):
+        return dir(self._obj)
+
+    def __repr__(self):
+        return f'<cached {self._obj!r}>'
+
+
+def cached(obj):
+    """
+    Return a caching proxy for a pymeasure instrument. The cache is kept per
+    instrument, so repeated calls share the known state.
+    """
+    if isinstance(obj, CachingProxy):
+        return obj
+    if obj not in _caches:
+        _caches[obj] = SettingsCache()
+    return CachingProxy(obj, _caches[obj])
+
+
+def get_cache(obj):
+    """
+    The SettingsCache of a proxy or of an instrument that was `cached`.
+    """
+    if isinstance(obj, CachingProxy):
+        return obj._cache
+    if obj not in _caches:
+        _caches[obj] = SettingsCache()
+    return _caches[obj]
+
+
+def invalidate(obj, *names):
+    """
+    Forget the known state of `obj` (a proxy, or an instrument that was
+    `cached`), or only of the given property names. For a channel proxy,
+    only the state of that channel is forgotten.
+    """
+    key = obj._key if isinstance(obj, CachingProxy) else ()
+    get_cache(obj).invalidate(prefix=key, names=names)
+
+
+def stats(obj):
+    """
+    {'sent': <n writes sent>, 'skipped': <n writes skipped>}.
+    """
+    return get_cache(obj).stats()
+
+
+@contextmanager
+def batch(obj):
+    """
+    Coalesce the writes to `obj` (instrument or channel, proxy or not) made
+    within the block into a single SCPI line, sent when the block exits.
+    Queries within the block first flush the queued writes. If the block
+    or sending the queued writes raises, the queued writes are dropped and
+    the cache is invalidated.
+
+    Usage:
+    -----
+    with batch(fngen):
+        fngen.channels[2].amplitude = 1
+        fngen.channels[2].offset = .5
+    """
+    root = obj._obj if isinstance(obj, CachingProxy) else obj
+    while isinstance(root, Channel):
+        root = root.parent
+    if not isinstance(root, Instrument) or 'write' in vars(root):
+        # nested batch: the outer one sends everything. Or not a local
+        # pymeasure instrument (e.g. a server.RemoteObject): write directly.
+        yield
+        return
+    write = root.write
+    queued = []
+
+    def flush():
+        if queued:
+            write(';'.join(c if c[:1] in (':', '*') else ':' + c
+                           for c in queued))
+            queued.clear()
+
+    def queue_write(command, **kwargs):
+        if '?' in command or kwargs:
+            flush()
+            write(command, **kwargs)
+        else:
+            queued.append(command)
+
+    root.write = queue_write
+    try:
+        yield
+    except BaseException:
+        queued.clear()
+        invalidate(root)
+        raise
+    finally:
+        del root.write
+    try:
+        flush()
+    except BaseException:  # unknown which of the writes took effect
+        invalidate(root)
+        raise
+
+
+def _is_setting(obj, name):
+    attr = getattr(type(obj), name, None)
+    return isinstance(attr, property) and attr.fset is not None
+
+
+def _equal(a, b):
+    try:
+        return bool(a == b)
+    except (TypeError, ValueError):  # e.g. arrays
+        return False
+
+
+def _wrap(value, cache, key):
+    if isinstance(value, Channel):
+        # key by channel ID, so that e.g. vna.ch_1 and vna.channels[1] share
+        # the same state.
+        return CachingProxy(value, cache,
+                            key + (type(value).__name__, value.id))
+    if isinstance(value, dict) and len(value) > 0 and all(
+            isinstance(v, Channel) for v in value.values()):
+        return {k: _wrap(v, cache, key) for k, v in value.items()}
+    return value
@@ -0,0 +1,256 @@
+"""
+Indexed SQLite database of measurement runs.
+
+Tables:
+- runs: one row per run (laser ID, wavelength, timestamp, script).
+- points: one row per bias point of a run (mA, V, mW, ...). Columns are
+  added on the fly when a script records a new quantity.
+- settings: instrument settings of a run as (instrument, key, value).
+
+Runs are indexed by laser ID, wavelength and timestamp, so e.g. "all runs
+of laser X at 650 nm" does not need to open any spreadsheet. Spreadsheets
+in the usual <laserid>_mA/_V/_mW layout are an export/import view over
+the database, see `export_spreadsheet` and `import_spreadsheet`.
+
+Recording runs only needs the standard library; pandas is imported by the
+query and export methods, so scripts that only record start quickly.
+"""
+import json
+import re
+import sqlite3
+from datetime import datetime
+
+DEFAULT_DB = 'measurement_tools.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    laserid TEXT,
+    wavelength REAL,
+    timestamp TEXT NOT NULL,
+    script TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_laserid
+    ON runs (laserid, wavelength, timestamp);
+CREATE INDEX IF NOT EXISTS runs_wavelength ON runs (wavelength, timestamp);
+CREATE INDEX IF NOT EXISTS runs_timestamp ON runs (timestamp);
+CREATE TABLE IF NOT EXISTS points (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    idx INTEGER NOT NULL,
+    mA REAL,
+    V REAL,
+    mW REAL,
+    PRIMARY KEY (run_id, idx)
+);
+CREATE TABLE IF NOT EXISTS settings (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    instrument TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (run_id, instrument, key)
+);
+"""
+
+
+class ResultsDB:
+    """
+    Usage:
+    -----
+    db = ResultsDB()
+    run = db.start_run(laserid='laser1', wavelength=650, script='laser_PIV')
+    run.append(mA=1, V=1.8, mW=.1)
+    db.find_runs(laserid='laser1', wavelength=650)
+    """
+
+    def __init__(self, fname=DEFAULT_DB):
+        self.fname = fname
+        self.conn = sqlite3.connect(fname, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+        self._point_columns = {
+            row[1] for row in self.conn.execute('PRAGMA table_info(points)')}
+
+    def start_run(self, laserid=None, wavelength=None, script=None,
+                  settings=None, timestamp=None):
+        """
+        Register a new run and return a `RunWriter` for its bias points.
+
+        Parameters:
+        ----------
+        settings: optional dict {instrument: {key: value}}.
+        timestamp: datetime, defaults to now.
+        """
+        timestamp = (timestamp or datetime.now()).isoformat()
+        with self.conn:
+            cur = self.conn.execute(
+                'INSERT INTO runs (laserid, wavelength, timestamp, script) '
+                'VALUES (?, ?, ?, ?)',
+                (laserid, wavelength, timestamp, script))
+        run = RunWriter(self, cur.lastrowid, laserid)
+        for instrument, values in (settings or {}).items():
+            self.add_settings(run.id, instrument, values)
+        return run
+
+    def add_settings(self, run_id, instrument, values):
+        """
+        Record (or update) settings of an instrument for a run. Values are
+        stored as JSON.
+        """
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO settings VALUES (?, ?, ?, ?)',
+                [(run_id, instrument, k, json.dumps(v, default=str))
+                 for k, v in values.items()])
+
+    def add_point(self, run_id, idx, **values):
+        """
+        Record a bias point. Committed immediately.
+        """
+        self._ensure_columns(values.keys())
+        columns = ', '.join(['run_id', 'idx'] + [f'"{k}"' for k in values])
+        qmarks = ', '.join('?' * (len(values) + 2))
+        with self.conn:
+            self.conn.execute(
+                f'INSERT OR REPLACE INTO points ({columns}) '
+                f'VALUES ({qmarks})',
+                (run_id, idx, *[_to_sql(v) for v in values.values()]))
+
+    def _ensure_columns(self, keys):
+        for k in keys:
+            if k in self._point_columns:
+                continue
+            if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', k):
+                raise ValueError(f'Invalid point quantity name: {k!r}')
+            with self.conn:
+                self.conn.execute(f'ALTER TABLE points ADD COLUMN "{k}" REAL')
+            self._point_columns.add(k)
+
+    def find_runs(self, laserid=None, wavelength=None, since=None,
+                  until=None, script=None):
+        """
+        Return a DataFrame of the runs matching all given criteria.
+        `since`/`until` are datetimes (or ISO format strings).
+        """
+        clauses, params = [], []
+        for column, op, value in [('laserid', '=', laserid),
+                                  ('wavelength', '=', wavelength),
+                                  ('timestamp', '>=', since),
+                                  ('timestamp', '<', until),
+                                  ('script', '=', script)]:
+            if value is not None:
+                if isinstance(value, datetime):
+                    value = value.isoformat()
+                clauses.append(f'{column} {op} ?')
+                params.append(value)
+        where = ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
+        import pandas as pd
+        return pd.read_sql_query(
+            f'SELECT * FROM runs {where} ORDER BY timestamp', self.conn,
+            params=params)
+
+    def points(self, run_ids):
+        """
+        Long-format DataFrame of the bias points of the given runs, with the
+        same 'run', 'laserid' and 'idx' columns as `results.read_results`.
+        """
+        run_ids = list(run_ids)
+        qmarks = ', '.join('?' * len(run_ids))
+        import pandas as pd
+        return pd.read_sql_query(
+            'SELECT points.run_id AS run, runs.laserid, points.* '
+            'FROM points JOIN runs ON points.run_id = runs.id '
+            f'WHERE points.run_id IN ({qmarks}) '
+            'ORDER BY runs.timestamp, points.idx',
+            self.conn, params=run_ids).drop(columns=['run_id'])
+
+    def settings(self, run_id):
+        """
+        Settings of a run as {instrument: {key: value}}.
+        """
+        out = {}
+        for instrument, k, v in self.conn.execute(
+                'SELECT instrument, key, value FROM settings '
+                'WHERE run_id = ?', (run_id,)):
+            out.setdefault(instrument, {})[k] = json.loads(v)
+        return out
+
+    def to_dataframe(self, run_ids=None, **query):
+        """
+        Spreadsheet (<laserid>_mA/_V/_mW) view of the runs. Either give
+        `run_ids` or `find_runs` criteria.
+        """
+        from measurement_tools import results
+        if run_ids is None:
+            run_ids = self.find_runs(**query)['id']
+        return results.results_to_spreadsheet_df(self.points(run_ids))
+
+    def export_spreadsheet(self, fname, run_ids=None, overwrite=False,
+                           **query):
+        """
+        Write runs to a .csv/.xlsx spreadsheet. Adds columns to an existing
+        spreadsheet unless `overwrite`.
+        """
+        from measurement_tools import spreadsheet
+        df = self.to_dataframe(run_ids, **query)
+        if overwrite:
+            spreadsheet.write_spreadsheet(fname, df)
+        else:
+            spreadsheet.add_to_spreadsheet(fname, df)
+        return df
+
+    def import_spreadsheet(self, fname, wavelength=None, **kwargs):
+        """
+        Import every <laserid>_mA/_V/_mW column group of a spreadsheet as a
+        run, e.g. to index spreadsheets written before this database
+        existed. Returns the new run IDs.
+        """
+        import pandas as pd
+        from measurement_tools import spreadsheet
+        df = spreadsheet.read_spreadsheet(fname, **kwargs)
+        run_ids = []
+        for column in df.columns:
+            if not column.endswith('_mA'):
+                continue
+            laserid = column[:-len('_mA')]
+            quantities = {q: df[f'{laserid}_{q}'] for q in ['mA', 'V', 'mW']
+                          if f'{laserid}_{q}' in df}
+            run = self.start_run(laserid=laserid, wavelength=wavelength,
+                                 script=f'import:{fname}')
+            for idx in range(len(df)):
+                if pd.isna(quantities['mA'].iloc[idx]):
+                    continue
+                run.append(**{q: v.iloc[idx] for q, v in quantities.items()})
+            run_ids.append(run.id)
+        return run_ids
+
+    def close(self):
+        self.conn.close()
+
+
+class RunWriter:
+    """
+    Returned by `ResultsDB.start_run`. Has the same `append` interface as
+    `results.ResultWriter`.
+    """
+
+    def __init__(self, db, run_id, laserid):
+        self.db = db
+        self.id = run_id
+        self.laserid = laserid
+        self.npoints = 0
+
+    def append(self, **values):
+        self.db.add_point(self.id, self.npoints, **values)
+        self.npoints += 1
+
+    def add_settings(self, instrument, values):
+        self.db.add_settings(self.id, instrument, values)
+
+    def close(self):
+        pass
+
+
+def _to_sql(v):
+    v = float(v)
+    return None if v != v else v  # NaN -> NULL
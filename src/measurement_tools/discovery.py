@@ -0,0 +1,209 @@
+"""
+Instrument discovery: VISA scan, mDNS/LXI browsing and probing of the known
+lab LAN instruments, run in parallel, merged, and cached with a TTL.
+
+`rm.list_resources()` is slow and often misses LAN instruments. Discovered
+resources are cached in .measurement_tools_discovery (in the current
+directory, like the .measurement_tools VISA ID cache), so a warm
+`list_resources()` returns without touching the network or VISA backend.
+"""
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CACHE_FILE = '.measurement_tools_discovery'
+DEFAULT_TTL = 300  # s
+
+# mDNS service types advertised by LXI instruments -> VISA resource format.
+MDNS_SERVICES = {
+    '_lxi._tcp.local.': 'TCPIP::{address}::INSTR',
+    '_vxi-11._tcp.local.': 'TCPIP::{address}::INSTR',
+    '_hislip._tcp.local.': 'TCPIP::{address}::hislip0::INSTR',
+    '_scpi-raw._tcp.local.': 'TCPIP::{address}::{port}::SOCKET',
+}
+
+# Stop browsing mDNS when no answer arrived for this long (s).
+MDNS_QUIET = .25
+
+# Lab instruments with static addresses: the E5062A VNA, and the Tek scope
+# (see wrappers.TekScope).
+KNOWN_HOSTS = ['192.168.2.233', '169.254.8.194']
+
+# TCP port -> VISA resource format, for probing KNOWN_HOSTS.
+PROBE_PORTS = {
+    111: 'TCPIP::{address}::INSTR',  # VXI-11 portmapper
+    5025: 'TCPIP::{address}::5025::SOCKET',  # SCPI raw socket
+}
+
+
+def visa_scan(rm=None):
+    """
+    Resources found by pyvisa. Uses the shared ResourceManager by default.
+    """
+    if rm is None:
+        from measurement_tools import resources
+        rm = resources.resource_manager()
+    return set(rm.list_resources())
+
+
+def browse_mdns(timeout=1., zc=None, quiet=MDNS_QUIET):
+    """
+    Browse mDNS for MDNS_SERVICES, until no new answer arrived for `quiet`
+    seconds (responders answer within ~0.1 s), or at most `timeout` seconds.
+
+    Parameters:
+    ----------
+    zc: zeroconf.Zeroconf instance to browse with. By default, one is
+      created (and closed) for the call. Pass your own e.g. to browse on
+      specific interfaces, or to test against a local responder.
+
+    Returns:
+    -------
+    set of VISA resource names.
+    """
+    from zeroconf import ServiceBrowser, Zeroconf
+
+    found = set()
+    cond = threading.Condition()
+    state = {'pending': 0, 'last': time.perf_counter()}
+
+    def activity(pending):
+        with cond:
+            state['pending'] += pending
+            state['last'] = time.perf_counter()
+            cond.notify()
+
+    class Listener:
+        def add_service(self, zc, type_, name):
+            activity(1)
+            try:
+                info = zc.get_service_info(type_, name,
+                                           timeout=int(timeout * 1000))
+                if info is not None:
+                    with cond:
+                        for address in info.parsed_addresses():
+                            found.add(MDNS_SERVICES[type_].format(
+                                address=address, port=info.port))
+            finally:
+                activity(-1)
+
+        def update_service(self, zc, type_, name):
+            self.add_service(zc, type_, name)
+
+        def remove_service(self, zc, type_, name):
+            pass
+
+    own_zc = zc is None
+    if own_zc:
+        zc = Zeroconf()
+    try:
+        deadline = time.perf_counter() + timeout
+        browser = ServiceBrowser(zc, list(MDNS_SERVICES), Listener())
+        with cond:
+            while True:
+                now = time.perf_counter()
+                if now >= deadline or (state['pending'] == 0
+                                       and now - state['last'] >= quiet):
+                    break
+                cond.wait(min(deadline, state['last'] + quiet) - now
+                          if state['pending'] == 0 else deadline - now)
+        browser.cancel()
+    finally:
+        if own_zc:
+            zc.close()
+    with cond:
+        return set(found)
+
+
+def probe_hosts(hosts=KNOWN_HOSTS, timeout=.3):
+    """
+    Try to connect to PROBE_PORTS of each host in parallel.
+
+    Returns:
+    -------
+    set of VISA resource names.
+    """
+    def probe(host_port):
+        host, port = host_port
+        try:
+            with socket.create_connection((host, port), timeout=timeout):
+                return PROBE_PORTS[port].format(address=host)
+        except OSError:
+            return None
+
+    targets = [(h, p) for h in hosts for p in PROBE_PORTS]
+    if len(targets) == 0:
+        return set()
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        return {r for r in pool.map(probe, targets) if r is not None}
+
+
+def _discover(rm=None, timeout=1., zc=None, hosts=KNOWN_HOSTS,
+              probe_timeout=.3):
+    """
+    `discover`, but returns (VISA scan results, LAN results) as sets.
+    """
+    jobs = {
+        'VISA scan': lambda: visa_scan(rm),
+        'mDNS': lambda: browse_mdns(timeout=timeout, zc=zc),
+        'host probe': lambda: probe_hosts(hosts, timeout=probe_timeout),
+    }
+    found = {name: set() for name in jobs}
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        futures = {name: pool.submit(job) for name, job in jobs.items()}
+        for name, future in futures.items():
+            try:
+                found[name] = future.result()
+            except Exception as e:
+                print(f'Warning: {name} failed: {e}')
+    return found['VISA scan'], found['mDNS'] | found['host probe']
+
+
+def discover(rm=None, timeout=1., zc=None, hosts=KNOWN_HOSTS,
+             probe_timeout=.3):
+    """
+    Run the VISA scan, mDNS browsing and host probing in parallel and merge
+    the results. A failing method (e.g. no network) is reported and skipped.
+    mDNS browsing stops early when answers stop coming in (see
+    `browse_mdns`), so this usually takes as long as the VISA scan alone.
+
+    Returns:
+    -------
+    sorted list of VISA resource names.
+    """
+    visa, lan = _discover(rm, timeout=timeout, zc=zc, hosts=hosts,
+                          probe_timeout=probe_timeout)
+    return sorted(visa | lan)
+
+
+def list_resources(rm=None, ttl=DEFAULT_TTL, refresh=False,
+                   cache_file=CACHE_FILE, live_visa=False, **kwargs):
+    """
+    Discovered resources (see `discover`, which kwargs are passed to),
+    from the cache file if it is younger than `ttl` seconds and `refresh`
+    is False.
+
+    With `live_visa`, only the LAN results (mDNS, host probes) are taken
+    from the cache: the VISA scan is always run, so that e.g. a USB
+    instrument plugged in (or out) since the cache was written is listed
+    correctly.
+    """
+    if not refresh and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+            if time.time() - cache['timestamp'] < ttl:
+                if live_visa:
+                    return sorted(visa_scan(rm) | set(cache['lan']))
+                return cache['resources']
+        except (ValueError, KeyError):
+            pass  # corrupt (or old format) cache, rediscover
+    visa, lan = _discover(rm=rm, **kwargs)
+    found = sorted(visa | lan)
+    with open(cache_file, 'w') as f:
+        json.dump({'timestamp': time.time(), 'resources': found,
+                   'lan': sorted(lan)}, f)
+    return found
@@ -5,6 +5,10 @@ Alec Vercruysse
 import json
 import os
 import pprint
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from measurement_tools import discovery
 
 
 def confirm(question, default=True):
@@ -29,7 +33,30 @@ def confirm(question, default=True):
         return confirm(question, default=default)
 
 
-def get_pyvisa_instr_ID(rm, mytype=None, skip_confirm=True):
+# *IDN? patterns of the instruments each `mytype` refers to.
+IDN_PATTERNS = {
+    'LaserDriver': r'Arroyo',
+    'OpticalPowerMeter': r'Thorlabs,\s*PM100',
+    'Agilent33500': r'(Agilent|Keysight)[^,]*,\s*335\d\d',
+    'AgilentE5602A': r'E5062A',
+    'KeysightB2912A': r'B29\d\d',
+}
+
+# Settings to probe resources with, per VISA interface type. The serial
+# settings are the Arroyo laser driver's (see arroyo.py).
+PROBE_SETTINGS = {
+    'ASRL': {'baud_rate': 38400, 'write_termination': '\n',
+             'data_bits': 8},
+}
+
+# The `mytype`s connected over a serial port. Only these probe the ASRL
+# resources: writing to an unknown serial port (at another baud rate) can
+# disturb whatever is connected there.
+SERIAL_TYPES = {'LaserDriver'}
+
+
+def get_pyvisa_instr_ID(rm, mytype=None, skip_confirm=True,
+                        auto_identify=True):
     """
     Given a pyvisa RM object, guide the user to figure out which /dev/tty
     port the instrument is connected to. This creates a .measurement-tools
@@ -38,6 +65,14 @@ def get_pyvisa_instr_ID(rm, mytype=None, skip_confirm=True):
     to get an ID, it provides a 'mytype' value to store as an ID. Next time
     a script is run, the ID is remembered.
 
+    If `auto_identify` and `mytype` has an entry in IDN_PATTERNS, the
+    unopened instruments are first queried for *IDN? in parallel and the
+    matching one is picked without asking (see `auto_identify_instr` for
+    which ones are probed). The cache then also stores the
+    serial number. A cached VISA ID is returned without probing it: connect
+    with `connect_instr`, which looks the instrument up again by serial if
+    it is no longer there (e.g. USB enumeration order changed).
+
     Arguments:
     ---------
     mytype: any, optional, default None.
@@ -45,36 +80,46 @@ def get_pyvisa_instr_ID(rm, mytype=None, skip_confirm=True):
 
     TODO check how this works on Mac and Windows and adapt.
     """
+    auto_identify = auto_identify and mytype in IDN_PATTERNS
     if os.path.exists('.measurement_tools'):
         with open('.measurement_tools', 'r') as f:
             cache = json.load(f)
         if mytype is not None and mytype in cache:
-            print(f'Found previous assignment of {mytype}->{cache[mytype]}')
-            if skip_confirm or confirm("Use this VISA ID?"):
-                return cache[mytype]
+            entry = cache[mytype]
+            resource = _cached_resource(entry)
+            print(f'Found previous assignment of {mytype}->{resource}')
+            if (isinstance(entry, dict) and auto_identify) or \
+                    skip_confirm or confirm("Use this VISA ID?"):
+                return resource
     else:
         cache = None
-    instrs = sorted(list(rm.list_resources()))
+    if auto_identify:
+        found = auto_identify_instr(rm, mytype)
+        if found is not None:
+            _remember(cache, mytype, found)
+            return found['resource']
+    instrs = list_resources(rm)
     names_in_use = [n.resource_name for n in rm.list_opened_resources()]
     if len(names_in_use) > 0:
         print(f"Note: ingoring {names_in_use} since already in use.")
     instrs = sorted(list(set(instrs) - set(names_in_use)))
     instr_options = instrs.copy()
     if cache is not None:
+        cached = {_cached_resource(v): k for k, v in cache.items()}
         for idx, instr in enumerate(instr_options):
-            if instr in cache.values():
-                hint = list(cache.keys())[list(cache.values()).index(instr)]
-                instr_options[idx] = f'{instr} (cached: <- {hint} )'
+            if instr in cached:
+                instr_options[idx] = f'{instr} (cached: <- {cached[instr]} )'
     if len(instrs) > 1:
         instr_idx = option_list(instr_options,
                                 'Choose Instrument VISA ID ' +
                                 '(press <enter> if you don\'t know):',
                                 default='')
         if instr_idx == '':
+            plugged = set(rm.list_resources())  # live, like the scan after
             print('Determining ID automatically. ' +
                   'Unplug Instrument and press <enter>:')
             input('> ')
-            diff = set(instrs) - set(rm.list_resources())
+            diff = plugged - set(rm.list_resources())
             print(f'These IDs were disconnected: {list(diff)}')
             if cache is not None:
                 print('The following assignments were found in the cache:')
@@ -88,19 +133,235 @@ def get_pyvisa_instr_ID(rm, mytype=None, skip_confirm=True):
     else:
         raise Exception('No unopened (VISA) instrument found :(')
 
-    if os.path.exists('.measurement_tools'):
+    _remember(cache, mytype, instrs[instr_idx])
+    return instrs[instr_idx]
+
+
+def list_resources(rm, refresh=False):
+    """
+    Resources currently found by pyvisa, plus the LAN instruments (mDNS,
+    known hosts) that `rm.list_resources()` often misses, from the
+    discovery cache if it is fresh (and not `refresh`). See
+    `discovery.list_resources`: on a cold cache, the one VISA scan runs in
+    parallel with the LAN discovery.
+    """
+    return discovery.list_resources(rm, refresh=refresh, live_visa=True)
+
+
+def _cached_resource(entry):
+    """
+    Cache entries are either a bare VISA ID (old format) or a dict with the
+    VISA ID, *IDN? response and serial number.
+    """
+    return entry['resource'] if isinstance(entry, dict) else entry
+
+
+def _remember(cache, mytype, entry):
+    resource = _cached_resource(entry)
+    if cache is not None:
         if mytype is not None and confirm(
-                f'Remember {mytype}->{instrs[instr_idx]} in the future?'):
-            cache[mytype] = instrs[instr_idx]
+                f'Remember {mytype}->{resource} in the future?'):
+            cache[mytype] = entry
             with open('.measurement_tools', 'w') as f:
                 json.dump(cache, f)
     elif mytype is not None and confirm(
             'Create cache file .measurement_tools to ' +
             'remember device ID in the future?'):
-        cache = {mytype: instrs[instr_idx]}
+        cache = {mytype: entry}
         with open('.measurement_tools', 'w') as f:
             json.dump(cache, f)
-    return instrs[instr_idx]
+
+
+def _cached_serial(mytype, resource):
+    """
+    Serial number cached for `mytype` at `resource`, or None.
+    """
+    if not os.path.exists('.measurement_tools'):
+        return None
+    with open('.measurement_tools', 'r') as f:
+        entry = json.load(f).get(mytype)
+    if isinstance(entry, dict) and entry.get('resource') == resource:
+        return entry.get('serial')
+    return None
+
+
+def _resources_of_other_types(mytype):
+    """
+    VISA IDs cached for other types than `mytype`.
+    """
+    if not os.path.exists('.measurement_tools'):
+        return []
+    with open('.measurement_tools', 'r') as f:
+        cache = json.load(f)
+    return [_cached_resource(v) for k, v in cache.items() if k != mytype]
+
+
+def relocate_instr(rm, mytype, resource):
+    """
+    `mytype` is not (or no longer) at the cached VISA ID `resource`: search
+    for it by its cached serial number (see `auto_identify_instr`), and
+    update the cache. If it is not found, the cached assignment is dropped
+    and the instrument is identified from scratch (`get_pyvisa_instr_ID`).
+
+    Returns:
+    -------
+    The new VISA ID.
+    """
+    cache = {}
+    if os.path.exists('.measurement_tools'):
+        with open('.measurement_tools', 'r') as f:
+            cache = json.load(f)
+    serial = _cached_serial(mytype, resource)
+    print(f'{mytype} (serial {serial}) is no longer at {resource}. '
+          'Searching...')
+    found = auto_identify_instr(rm, mytype, serial=serial) \
+        if serial is not None and mytype in IDN_PATTERNS else None
+    if found is not None:
+        cache[mytype] = found
+    else:
+        cache.pop(mytype, None)
+    with open('.measurement_tools', 'w') as f:
+        json.dump(cache, f)
+    if found is not None:
+        return found['resource']
+    return get_pyvisa_instr_ID(rm, mytype=mytype)
+
+
+def connect_instr(rm, mytype, connect, name=None, disconnect=None):
+    """
+    Connect to the instrument `mytype` at `name`, by default its cached (or
+    chosen) VISA ID (see `get_pyvisa_instr_ID`). The cached ID is trusted
+    without probing it first: only if `connect` fails, or the instrument
+    there has another serial number than the cached one, is the instrument
+    looked up again (`relocate_instr`).
+
+    Parameters:
+    ----------
+    connect: callable(name) -> (instrument, *IDN? response or None if it
+      was not queried, e.g. a reused connection). Raises if it can't
+      connect.
+    disconnect: callable(instrument), to close a wrong instrument.
+
+    Returns:
+    -------
+    (instrument, VISA ID)
+    """
+    if name is not None:
+        return connect(name)[0], name
+    name = get_pyvisa_instr_ID(rm, mytype=mytype)
+    serial = _cached_serial(mytype, name)
+    try:
+        instr, idn = connect(name)
+    except Exception as e:
+        if serial is None:
+            raise
+        print(f'Could not connect to {mytype} at {name}: {e}')
+    else:
+        if serial is None or idn is None or parse_serial(idn) == serial:
+            return instr, name
+        print(f'Found {idn} at {name}.')
+        if disconnect is not None:
+            disconnect(instr)
+    name = relocate_instr(rm, mytype, name)
+    return connect(name)[0], name
+
+
+def identify_resources(rm, resources, timeout=500):
+    """
+    Query *IDN? of all `resources` in parallel, with a short timeout (ms)
+    and the interface specific settings of PROBE_SETTINGS.
+
+    Note that this opens and writes to each resource, e.g. a serial port is
+    reconfigured to 38400 baud. Only pass resources that may be disturbed
+    (see `auto_identify_instr`); each silent one costs `timeout` twice.
+
+    Returns:
+    -------
+    dict {resource: *IDN? response, or None if it did not answer}
+    """
+    def probe(resource):
+        try:
+            instr = rm.open_resource(resource, open_timeout=timeout)
+        except Exception:
+            return None
+        try:
+            instr.timeout = timeout
+            interface = re.match(r'[A-Za-z]+', resource)
+            settings = PROBE_SETTINGS.get(
+                interface.group(0).upper() if interface else '', {})
+            for k, v in settings.items():
+                setattr(instr, k, v)
+            for _ in range(2):  # the laser driver fails the first time.
+                try:
+                    return instr.query('*IDN?').strip()
+                except Exception:
+                    pass
+            return None
+        finally:
+            try:
+                instr.close()
+            except Exception:
+                pass
+
+    resources = list(resources)
+    if len(resources) == 0:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(resources)) as pool:
+        return dict(zip(resources, pool.map(probe, resources)))
+
+
+def parse_serial(idn):
+    """
+    Serial number field of an *IDN? response
+    (<manufacturer>,<model>,<serial>,<firmware>), or None.
+    """
+    fields = idn.split(',')
+    return fields[2].strip() if len(fields) > 2 else None
+
+
+def auto_identify_instr(rm, mytype, serial=None):
+    """
+    Find the unopened instrument whose *IDN? matches IDN_PATTERNS[mytype]
+    (and `serial`, if given). Asks the user to choose if several match.
+
+    Resources cached for another type in .measurement_tools are not
+    probed, since they may be open in another process (e.g. the
+    instrument_server), and serial ports (ASRL) only for SERIAL_TYPES.
+
+    Returns:
+    -------
+    dict {'resource': VISA ID, 'idn': *IDN? response, 'serial': serial},
+    or None if no instrument matched.
+    """
+    names_in_use = [n.resource_name for n in rm.list_opened_resources()]
+    names_in_use += _resources_of_other_types(mytype)
+    idns = {}
+    for refresh in (False, True):
+        # (a cached resource list may miss a newly connected instrument)
+        resources = sorted(set(list_resources(rm, refresh=refresh))
+                           - set(names_in_use) - set(idns))
+        if mytype not in SERIAL_TYPES:
+            resources = [r for r in resources
+                         if not r.upper().startswith('ASRL')]
+        print(f'Identifying {len(resources)} instruments with *IDN?...')
+        idns.update(identify_resources(rm, resources))
+        matches = [{'resource': r, 'idn': idn, 'serial': parse_serial(idn)}
+                   for r, idn in idns.items() if idn is not None
+                   and re.search(IDN_PATTERNS[mytype], idn)
+                   and (serial is None or parse_serial(idn) == serial)]
+        if len(matches) > 0:
+            break
+    if len(matches) == 0:
+        print(f'No {mytype} found automatically.')
+        return None
+    if len(matches) == 1:
+        idx = 0
+    else:
+        idx = option_list([f"{m['resource']} ({m['idn']})" for m in matches],
+                          f'Found several {mytype}s. Choose one:')
+    print(f"Identified {mytype}: {matches[idx]['resource']} "
+          f"({matches[idx]['idn']})")
+    return matches[idx]
 
 
 def option_list(options, prompt='Choose an option:', default=None):
@@ -0,0 +1,100 @@
+"""
+Process-wide pyvisa ResourceManager and pool of open instrument
+connections.
+
+Creating a ResourceManager initializes the VISA backend, which is slow, so
+every factory in `wrappers` (and LaserDriver) shares the one returned by
+`resource_manager()`. Connections are pooled by key (e.g. (factory name,
+resource name)) with reference counting: asking for an instrument that is
+already open returns the same object instead of reconnecting. Everything
+still open is closed at exit.
+"""
+import atexit
+import threading
+
+_rm = None
+_pool = {}  # key -> [object, close function, reference count]
+_lock = threading.RLock()
+
+
+def resource_manager():
+    """
+    The shared pyvisa ResourceManager, created on first use.
+    """
+    global _rm
+    with _lock:
+        if _rm is None:
+            import pyvisa
+            _rm = pyvisa.ResourceManager()
+            atexit.register(close_all)
+        return _rm
+
+
+def acquire(key, connect):
+    """
+    Return the pooled object for `key`, connecting with `connect()` if it
+    is not open yet. `connect` must return (object, close function).
+    Every `acquire` should be paired with a `release`.
+
+    Returns:
+    -------
+    (object, new): new is False if an open connection was reused.
+    """
+    with _lock:
+        if key in _pool:
+            _pool[key][2] += 1
+            return _pool[key][0], False
+        obj, close = connect()
+        _pool[key] = [obj, close, 1]
+        return obj, True
+
+
+def release(obj):
+    """
+    Drop a reference to a pooled object, and close it if that was the last
+    one. Objects that are not pooled are ignored.
+    """
+    obj = getattr(obj, '_obj', obj)  # unwrap a caching.CachingProxy
+    with _lock:
+        for key, entry in list(_pool.items()):
+            if entry[0] is obj:
+                entry[2] -= 1
+                if entry[2] == 0:
+                    del _pool[key]
+                    entry[1]()
+                return
+
+
+def open_resource(name, **kwargs):
+    """
+    Pooled `resource_manager().open_resource(name, **kwargs)`. kwargs only
+    apply when the resource is not open yet. Release with `release`.
+    """
+    rm = resource_manager()
+
+    def connect():
+        resource = rm.open_resource(name, **kwargs)
+        return resource, resource.close
+
+    return acquire(('resource', name), connect)[0]
+
+
+def close_all():
+    """
+    Close every pooled connection and the ResourceManager. Registered to run
+    at exit.
+    """
+    global _rm
+    with _lock:
+        while _pool:
+            key, (obj, close, _) = _pool.popitem()
+            try:
+                close()
+            except Exception as e:
+                print(f'Error closing {key}: {e}')
+        if _rm is not None:
+            try:
+                _rm.close()
+            except Exception as e:
+                print(f'Error closing the VISA resource manager: {e}')
+            _rm = None
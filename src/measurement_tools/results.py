@@ -0,0 +1,206 @@
+"""
+Append-only, crash-safe storage for sweep results.
+
+Each measured bias point is written as one JSON line and flushed to disk
+immediately, so a crash (or the laser driver watchdog) only ever loses the
+point that was being measured. Appending never reads the existing file, so
+the cost per point stays constant no matter how many sweeps the log holds.
+
+The log is "long format" (one row per point, tagged with a run ID and a
+laser ID). `export_results` pivots runs back into the usual
+<laserid>_mA, <laserid>_V, <laserid>_mW spreadsheet columns.
+
+A sidecar index (<log>.idx, see `index_fname`) records the byte range of
+each run, so reading one run seeks to it instead of parsing the whole
+history.
+"""
+import json
+import math
+import numbers
+import os
+from datetime import datetime
+
+import pandas as pd
+
+from measurement_tools import spreadsheet
+
+
+class ResultWriter:
+    """
+    Stream bias points to an append-only JSON-lines log.
+
+    Usage:
+    -----
+    with ResultWriter('results.jsonl', 'laser1') as w:
+        for ...:
+            w.append(mA=current, V=voltage, mW=power)
+    """
+
+    def __init__(self, fname, laserid, run=None, fsync=True):
+        """
+        Parameters:
+        ----------
+        fname: path of the log. Created if it does not exist.
+        laserid: human readable name of the laser, used to name the
+          exported columns.
+        run: unique run identifier. Defaults to a timestamp.
+        fsync: force each point to the disk (not just the OS cache).
+        """
+        self.fname = fname
+        self.laserid = laserid
+        self.run = run if run is not None else \
+            datetime.now().strftime('%Y%m%d-%H%M%S.%f')
+        self.fsync = fsync
+        self.npoints = 0
+        self.start = None  # offset of the first point in the log
+        if os.path.dirname(fname):
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+        self.f = open(fname, 'ab')
+
+    def append(self, **values):
+        """
+        Write one bias point (e.g. mA=.., V=.., mW=..) and flush it to disk.
+        NaNs are stored as null.
+        """
+        row = {'run': self.run, 'laserid': self.laserid,
+               'idx': self.npoints, 'time': datetime.now().isoformat()}
+        for k, v in values.items():
+            if isinstance(v, numbers.Integral):
+                row[k] = int(v)
+            else:
+                v = float(v)
+                row[k] = None if math.isnan(v) else v
+        line = (json.dumps(row) + '\n').encode('utf-8')
+        self.f.write(line)
+        self.f.flush()
+        if self.fsync:
+            os.fsync(self.f.fileno())
+        if self.start is None:
+            # (appends are atomic, the position is the end of our line)
+            self.start = self.f.tell() - len(line)
+            self._index(start=self.start)
+        self.npoints += 1
+
+    def _index(self, **entry):
+        with open(index_fname(self.fname), 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'run': self.run, **entry}) + '\n')
+
+    def close(self):
+        if not self.f.closed:
+            if self.start is not None:
+                self._index(stop=self.f.tell())
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def index_fname(fname):
+    """
+    Sidecar index of the log `fname`: JSON lines {"run": .., "start": ..}
+    when a run writes its first point and {"run": .., "stop": ..} when it
+    is closed, with byte offsets into the log.
+    """
+    return fname + '.idx'
+
+
+def _run_range(fname, run):
+    """
+    (start, stop) byte offsets of `run` in the log according to the index,
+    stop None if the run was not closed (e.g. crashed): read to the end.
+    None if the run is not indexed.
+    """
+    try:
+        with open(index_fname(fname), 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return None
+    start, stop = None, None
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if entry.get('run') == run:
+            start = entry.get('start', start)
+            stop = entry.get('stop', stop)
+    return None if start is None else (start, stop)
+
+
+def read_results(fname, run=None, laserid=None):
+    """
+    Read the log into a long-format DataFrame, optionally filtered by
+    run ID and/or laser ID. A partially written last line (e.g. from a
+    power failure mid-write) is ignored.
+
+    With `run`, only that run's byte range is read if it is in the index,
+    and lines of other runs are skipped without parsing them.
+    """
+    rows = []
+    # rows are written with 'run' first: match it as a string.
+    prefix = None if run is None else \
+        ('{"run": ' + json.dumps(run) + ',').encode('utf-8')
+    with open(fname, 'rb') as f:
+        lines = f
+        span = None if run is None else _run_range(fname, run)
+        if span is not None:
+            f.seek(span[0])
+            if f.readline().startswith(prefix):  # else a stale index
+                f.seek(span[0])
+                lines = f if span[1] is None else \
+                    f.read(span[1] - span[0]).splitlines(keepends=True)
+            else:
+                f.seek(0)
+        for line in lines:
+            if prefix is not None and not line.startswith(prefix):
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if run is not None and row['run'] != run:
+                continue
+            if laserid is not None and row['laserid'] != laserid:
+                continue
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def results_to_spreadsheet_df(df, quantities=('mA', 'V', 'mW')):
+    """
+    Pivot a long-format DataFrame (see `read_results`) into the wide
+    spreadsheet layout: one <laserid>_<quantity> column per quantity.
+    If a laser appears in several runs, the last run wins, consistent with
+    `spreadsheet.add_to_spreadsheet` replacing existing columns.
+    An empty `df` (e.g. no points matched) gives an empty DataFrame.
+    """
+    columns = {}
+    if len(df) == 0:
+        return pd.DataFrame(columns)
+    for run, run_df in df.groupby('run', sort=False):
+        run_df = run_df.sort_values('idx')
+        laserid = run_df['laserid'].iloc[0]
+        for q in quantities:
+            if q in run_df:
+                columns[f'{laserid}_{q}'] = run_df[q].reset_index(drop=True)
+    return pd.DataFrame(columns)
+
+
+def export_results(fname, out_fname, run=None, laserid=None, **kwargs):
+    """
+    Export (a subset of) the log to a .csv/.xlsx spreadsheet using the
+    same column layout as laser_PIV always has. kwargs are passed to
+    `spreadsheet.add_to_spreadsheet`. Nothing is written if there are no
+    matching points (e.g. a sweep aborted before its first point).
+    """
+    df = results_to_spreadsheet_df(read_results(fname, run=run,
+                                                laserid=laserid))
+    if len(df.columns) == 0:
+        print(f'No results (run {run}, laser {laserid}) in {fname} to '
+              'export.')
+        return df
+    spreadsheet.add_to_spreadsheet(out_fname, df, **kwargs)
+    return df
@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 import argparse
 
-from measurement_tools import interact, Agilent33500BFnGen
+from measurement_tools import interact, server
 
 
 def run(args):
-    i = Agilent33500BFnGen()
+    i = server.instruments(args.server).Agilent33500BFnGen()
     ch = i.channels[args.channel]
     if args.enable and args.disable:
         raise ValueError('Cannot both disable and enable the channel at once.')
@@ -64,4 +64,8 @@ def main():
                         help='Turn output off for the specified channel.')
     parser.add_argument('--interactive', '-i', action='store_true',
                         help='Enter interacftive interpreter.')
+    parser.add_argument('--server', nargs='?', const=server.DEFAULT_ADDRESS,
+                        help=f'''Use the instruments of a running
+                        instrument_server instead of connecting to them
+                        (default address {server.DEFAULT_ADDRESS}).''')
     run(parser.parse_args())
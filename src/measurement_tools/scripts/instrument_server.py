@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Run the instrument server (see measurement_tools.server), so that other
+scripts started with --server attach to already open instruments.
+"""
+import argparse
+
+from measurement_tools import server
+
+
+def main():
+    print('Running instrument-server.py. '
+          'Run instrument-server.py -h for help.')
+    parser = argparse.ArgumentParser(
+        prog='instrument-server.py',
+        description='''Keep instrument connections open in a long-lived
+        process. Scripts started with --server use these instruments
+        instead of connecting themselves. Instruments are opened on first
+        use; interactive prompts (e.g. choosing a VISA ID) appear in this
+        terminal. The laser driver output is disabled when this exits.''',
+        epilog="Contact: alecfv@berkeley.edu"
+    )
+    parser.add_argument('--address', '-a', default=server.DEFAULT_ADDRESS,
+                        help=f'''host:port (loopback, see --allow_remote) or
+                        Unix socket path to listen on. Default
+                        {server.DEFAULT_ADDRESS}''')
+    parser.add_argument('--allow_remote', '--allow-remote',
+                        action='store_true',
+                        help=f'''Allow listening on a non-loopback address.
+                        Anyone who can connect with the key (in
+                        {server.AUTHKEY_FILE}, copy it to the clients) can run
+                        code on this machine: only use on trusted
+                        networks.''')
+    parser.add_argument('--keep_output', action='store_true',
+                        help='''Don't disable the laser driver output when
+                        the last script disconnects.''')
+    args = parser.parse_args()
+    server.serve(args.address, disable_on_idle=not args.keep_output,
+                 allow_remote=args.allow_remote)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,25 @@
 #!/usr/bin/env python3
 import argparse
+import os
 import time
 import atexit
 import pdb
 
-import pandas as pd
 import numpy as np
 from tqdm import tqdm
 
-from measurement_tools import OpticalPowerMeter, LaserDriver, \
-    Agilent33500BFnGen, TekScope
-from measurement_tools import spreadsheet, interact
+from measurement_tools import interact, results, database, acquisition, \
+    caching, server, tek
 
 
 def disable_fn_gen(fngen):
     """
     Make sure to turn Fn Gen off if the script exits at any time!
     """
-    fngen.channels[2].output = False
+    # raw SCPI, so that a stale settings cache (e.g. the server's, which
+    # caching.invalidate can't reach) can never skip it.
+    fngen.write('OUTP2 OFF')
+    caching.invalidate(fngen.channels[2], 'output')
 
 
 def set_tint(f, tint_s):
@@ -27,8 +29,9 @@ def set_tint(f, tint_s):
     """
     if tint_s > 0:
         duty_cycle = 100 * tint_s / f.channels[2].pulse_period
-        f.channels[2].pulse_dutycycle = duty_cycle
-        f.channels[2].output = True
+        with caching.batch(f):
+            f.channels[2].pulse_dutycycle = duty_cycle
+            f.channels[2].output = True
     else:
         f.channels[2].output = False
 
@@ -37,20 +40,71 @@ def bias_pulsed(fngen, current):
     """
     Assumes laser driver is in low current mode, so the transfer fn
     is 50mA/V. input units mA.
+    Unchanged settings are not re-sent if `fngen` is cached, and the rest
+    is sent as one SCPI line.
     """
     v_top = current / 50
     if v_top < 0.01:  # can't go that low. (.5 mA or less, just turn it off)
         fngen.channels[2].output = False
         return
-    fngen.channels[2].amplitude = v_top
-    fngen.channels[2].offset = v_top / 2
-    fngen.channels[2].output = True
+    with caching.batch(fngen):
+        fngen.channels[2].amplitude = v_top
+        fngen.channels[2].offset = v_top / 2
+        fngen.channels[2].output = True
+
+
+def waveform_power(s, real_range):
+    """
+    Integration mode: average optical power over the 50 ms pulse from the
+    full CH4 waveform, or None if the scope did not trigger.
+    """
+    wfm = tek.retrieve_waveform(s, 'CH4')
+    if wfm is None:
+        return None
+    # map 2V to range:
+    return wfm.mean(0, 50e-3) / 2 * real_range
+
+
+def record(writers, **values):
+    """
+    Stream a bias point to the results log and database.
+    """
+    for w in writers:
+        w.append(**values)
+
+
+def log_remaining(writers, currents):
+    """
+    Log the rest of an aborted sweep as NaNs, so that the exported columns
+    keep the full list of bias currents.
+    """
+    for current in currents:
+        record(writers, mA=current, V=np.nan, mW=np.nan, mW_std=np.nan,
+               tint_s=np.nan, settle_s=np.nan, PV_corr=np.nan)
+
+
+def settle(read, args, abs_tol):
+    """
+    Read until the value settles (see `acquisition.settle`), warning if it
+    does not within the timeout. `abs_tol` (in the units of `read()`) lets
+    readings near zero settle, e.g. the power below threshold.
+    """
+    res = acquisition.settle(read, criterion=args.settle_criterion,
+                             tol=abs_tol, rel_tol=args.settle_tol,
+                             window=args.nsamples,
+                             timeout=args.settle_timeout,
+                             interval=args.settle_interval)
+    if not res.converged:
+        print(f"Warning: reading did not settle within {res.settle_time:.2f}"
+              f" s (std {res.std:.3g} of mean {res.mean:.3g}).")
+    return res
 
 
 def main(args):
+    instruments = server.instruments(args.server)
 
     # configure Power Meter
-    p = OpticalPowerMeter()
+    p = instruments.OpticalPowerMeter()
     p.configure.scalar.power()
     p.sense.correction.wavelength = args.wavelength
     if not args.integration_mode:  # default
@@ -60,13 +114,19 @@ def main(args):
         # The actual range is dependent on the wavelength setting...
         p.sense.power.dc.range.upper = 0.01    # >=10mW
         p.input.pdiode.filter.lpass.state = 0  # hi-bandwidth mode
+    if not args.integration_mode:
+        # average on the power meter, unless every read is a single sample.
+        count = acquisition.set_power_averaging(
+            p, 1 if args.settle or args.python_averaging or args.concurrent
+            else args.nsamples)
+        atexit.register(acquisition.set_power_averaging, p, count)
 
     # optionally configure fn gen
     assert not (args.pulsed and args.integration_mode)
     if args.pulsed:
         duty = .5  # 0-1
         freq = 2e3
-        f = Agilent33500BFnGen()
+        f = instruments.Agilent33500BFnGen(cached=True)
         atexit.register(lambda: disable_fn_gen(f))
         f.channels[2].output = False
         f.channels[2].shape = 'SQU'
@@ -76,7 +136,7 @@ def main(args):
         f.channels[2].burst_mode = 'TRIG'            # non-gated
         f.channels[2].trigger_source = 'IMMEDIATE'   # internal trigger
     if args.integration_mode:
-        f = Agilent33500BFnGen()
+        f = instruments.Agilent33500BFnGen(cached=True)
         atexit.register(lambda: disable_fn_gen(f))
         f.channels[2].output = False
         f.channels[2].amplitude_unit = 'VPP'
@@ -95,7 +155,7 @@ def main(args):
 
     # optionally configure scope
     if args.integration_mode:
-        s = TekScope()
+        s = instruments.TekScope()
         s.send_raw_command('*RST')  # reset scope'
         s.send_raw_command(':SELect:CH1 1')    # trig
         s.send_raw_command('CH1:SCALE 200E-3')  # 200mV/div (20mV = 1 mA)
@@ -110,9 +170,16 @@ def main(args):
         s.send_raw_command(':HORIZONTAL:RECOrdlength 1000000')  # 1M so fs=10 MS/s
         s.send_raw_command(':HORIZONTAL:POSITION 10')  # trig pos @ 10% f.s.
         time.sleep(3)  # TODO this is just to make sure the scope has time to reset
+        if not args.full_waveform:
+            # average the pulse on the scope, read back one number.
+            tek.setup_gated_mean(s, 'CH4', 0, 50e-3)
+        if args.full_waveform or args.verify_every > 0:
+            tek.setup_binary_transfer(s, nbytes=1)
+        # The actual range is dependent on the wavelength setting...
+        real_range = p.sense.power.dc.range.upper / 1.1
 
     # configure Laser Driver
-    i = LaserDriver(Io_max=args.Io_max, Vf_max=args.Vf_max)
+    i = instruments.LaserDriver(Io_max=args.Io_max, Vf_max=args.Vf_max)
     i.set_output_current(0)
     i.enable_output()
     time.sleep(0.5)  # wait to make sure there was no lockout
@@ -124,9 +191,25 @@ def main(args):
                          step=args.step, dtype=int)
     voltages = np.zeros_like(currents, dtype=float)
     powers = np.zeros_like(currents, dtype=float)
+    settle_times = []
     print(f"Sweep currents (mA): {currents}")
     assert interact.confirm("Instruments Configured. Start?")
+    log_fname = args.log if args.log is not None else \
+        os.path.splitext(args.filename)[0] + '_log.jsonl'
+    writer = results.ResultWriter(log_fname, args.laserid)
+    atexit.register(writer.close)
+    print(f"Streaming results to {log_fname} (run {writer.run})")
+    writers = [writer]
+    if not args.no_db:
+        db = database.ResultsDB(args.db)
+        writers.append(db.start_run(
+            laserid=args.laserid, wavelength=args.wavelength,
+            script='laser_PIV',
+            settings={'laser_PIV': vars(args),
+                      'LaserDriver': {'idn': i.idn}}))
+        print(f"Recording run in {args.db} (id {writers[-1].id})")
     for idx, current in tqdm(enumerate(currents), total=len(currents)):
+        extra = {}  # optional per-point values for the results log
         if args.pulsed or args.integration_mode:
             bias_pulsed(f, current)
         else:
@@ -140,18 +223,24 @@ def main(args):
             time.sleep(.5)
             f.trigger()
             time.sleep(1)
-            wfm = s.retrieve_waveform('CH4')
-            if wfm is None:
+            if args.full_waveform:
+                power = waveform_power(s, real_range)
+            else:
+                power = tek.read_measurement(s) / 2 * real_range
+                power = None if np.isnan(power) else power
+                if power is not None and args.verify_every > 0 and \
+                        idx % args.verify_every == 0:
+                    power_wfm = waveform_power(s, real_range)
+                    power_wfm = np.nan if power_wfm is None else power_wfm
+                    print(f"Verification: gated mean {power * 1e3:.4g} mW,"
+                          f" waveform mean {power_wfm * 1e3:.4g} mW")
+                    extra['mW_waveform'] = power_wfm * 1e3
+            if power is None:
                 print('Error: scope did not trigger')
                 powers[idx:] = np.nan
                 voltages[idx:] = np.nan
+                log_remaining(writers, currents[idx:])
                 break
-            t, v = np.array(wfm.time()), np.array(wfm.voltage())
-            # map 2V to range:
-            real_range = p.sense.power.dc.range.upper / 1.1
-            power = np.mean(
-                v[np.logical_and(t > 0,
-                                 t <= 50e-3)] / 2 * real_range)
             if power < 0:
                 print('''Error: Negative Optical Power recorded.
                 (TODO: Is the scope code detecting when
@@ -160,30 +249,62 @@ def main(args):
             # still in integration mode, now measure Vf
             i.set_output_current(current)
         # all modes:
-        time.sleep(.5)  # wait for power to stabilize.
-        if not args.integration_mode:
-            power = np.mean([p.read
-                             for _ in range(args.nsamples)])
-        voltage = np.mean([i.get_voltage()
-                           for _ in range(args.nsamples)])
+        power_std, tint, pv_corr = np.nan, np.nan, np.nan
+        if args.settle:
+            settle_time = 0
+            if not args.integration_mode:
+                res = settle(lambda: p.read, args,
+                             args.settle_abs_tol_mW / 1000)
+                power, settle_time = res.mean, res.settle_time
+                power_std = res.std
+            res = settle(i.get_voltage, args, args.settle_abs_tol_V)
+            voltage, settle_time = res.mean, settle_time + res.settle_time
+        else:
+            start = time.perf_counter()
+            time.sleep(.5)  # wait for power to stabilize.
+            if args.concurrent and not args.integration_mode:
+                vals, _ = acquisition.sample_concurrently(
+                    {'power': lambda: p.read, 'voltage': i.get_voltage},
+                    args.nsamples)
+                tint = args.nsamples * acquisition.PM100_SAMPLE_TIME
+                power = vals['power'].mean()
+                power_std = vals['power'].std(ddof=1)
+                voltage = vals['voltage'].mean()
+                pv_corr = np.corrcoef(vals['power'], vals['voltage'])[0, 1]
+            else:
+                if not args.integration_mode:
+                    pm = acquisition.measure_power(
+                        p, args.nsamples, hardware=not args.python_averaging,
+                        nrepeat=args.power_repeat)
+                    power, power_std, tint = pm.mean, pm.std, pm.tint
+                voltage = np.mean([i.get_voltage()
+                                   for _ in range(args.nsamples)])
+            settle_time = time.perf_counter() - start
+        settle_times.append(settle_time)
         if i.error:
             print("Exiting early due to error.")
             voltages[idx:] = np.nan
             powers[idx:] = np.nan
+            log_remaining(writers, currents[idx:])
             break
         voltages[idx] = voltage
-        powers[idx] = power * 1000 * (1 if not args.pulsed else 1 / duty)
+        scale = 1000 * (1 if not args.pulsed else 1 / duty)  # W -> mW
+        powers[idx] = power * scale
+        record(writers, mA=current, V=voltages[idx], mW=powers[idx],
+               mW_std=power_std * scale, tint_s=tint, settle_s=settle_time,
+               PV_corr=pv_corr, **extra)
         if args.pulsed:
             f.channels[2].output = False
         else:
             i.set_output_current(0)
-        time.sleep(.5)  # I hope this is enough cool-off time...
-    df = pd.DataFrame(data=np.array([currents, voltages, powers]).T,
-                      columns=[f'{args.laserid}_{m}'
-                               for m in ['mA', 'V', 'mW']]
-                      )
+        time.sleep(args.cooloff)  # I hope this is enough cool-off time...
+    writer.close()
+    if len(settle_times) > 0:
+        print(f"Settling + sampling took {np.mean(settle_times):.3f} s per "
+              f"point on average (max {np.max(settle_times):.3f} s).")
     print("saving...")
-    spreadsheet.add_to_spreadsheet(args.filename, df)
+    results.export_results(log_fname, args.filename, run=writer.run,
+                           incremental=args.incremental)
     print("done.")
 
 
@@ -208,6 +329,23 @@ if __name__ == "__main__":
                         Valid extensions are .csv or .xlsx.
                         Results are appended as columns with the names:
                         <laserid>_mA, <laserid>_mW, <laserid>_V''')
+    parser.add_argument('--incremental', action='store_true',
+                        help='''Don't rewrite the spreadsheet, append the
+                        results as a part next to it instead (fast for big
+                        shared spreadsheets). See
+                        spreadsheet.consolidate_spreadsheet.''')
+    parser.add_argument('--db', default=database.DEFAULT_DB,
+                        help=f'''SQLite results database to record the run
+                        in. Default {database.DEFAULT_DB}''')
+    parser.add_argument('--no_db', action='store_true',
+                        help='''Don't record the run in the results
+                        database.''')
+    parser.add_argument('--log', default=None,
+                        help='''Append-only log that every bias point is
+                        written to as soon as it is measured, so a crash
+                        does not lose the sweep. Defaults to
+                        <filename without extension>_log.jsonl. See
+                        measurement_tools.results to export old runs.''')
     parser.add_argument('--step', type=int,
                         help='''Step size, in units of integer mA, of sweep.
                         ''')
@@ -221,6 +359,56 @@ if __name__ == "__main__":
     parser.add_argument('--nsamples', '-n', type=int, default=20,
                         help='''Number of samples to take at each bias point.
                         Default 20.''')
+    parser.add_argument('--python_averaging', action='store_true',
+                        help='''Read the power meter nsamples times and
+                        average in python, instead of letting the power
+                        meter average nsamples samples and reading once.''')
+    parser.add_argument('--concurrent', action='store_true',
+                        help='''Read the power meter and the laser driver
+                        voltage at the same time (nsamples time-aligned
+                        pairs, each power sample unaveraged), which
+                        roughly halves the sampling time and records the
+                        power-voltage noise correlation (PV_corr in the
+                        results log). Ignored with -i.''')
+    parser.add_argument('--power_repeat', type=int, default=1,
+                        help='''Number of (power meter averaged) power
+                        readings per bias point. The noise of the power
+                        reading (mW_std in the results log) can only be
+                        estimated with >1 (or with --python_averaging,
+                        --concurrent or --settle); with 1 it is NaN.
+                        Default 1.''')
+    parser.add_argument('--settle', '-s', action='store_true',
+                        help='''Instead of waiting a fixed 0.5 s for the
+                        power to stabilize and then averaging nsamples
+                        reads, read the power and voltage until the last
+                        nsamples readings converge (see --settle_criterion).
+                        The settling time of each point is recorded.''')
+    parser.add_argument('--settle_criterion', default='stderr',
+                        choices=['stderr', 'slope'],
+                        help='''Convergence test of --settle: standard error
+                        of the mean, or drift (least squares slope) over
+                        the last nsamples readings. Default stderr.''')
+    parser.add_argument('--settle_tol', type=float, default=1e-3,
+                        help='''Relative tolerance of --settle.
+                        Default 1e-3.''')
+    parser.add_argument('--settle_abs_tol_mW', type=float, default=1e-5,
+                        help='''Absolute tolerance of --settle for the
+                        power, in mW, so that readings near zero (below
+                        threshold) settle. Default 1e-5 (10 nW, about the
+                        PM100D photodiode noise floor).''')
+    parser.add_argument('--settle_abs_tol_V', type=float, default=1e-3,
+                        help='''Absolute tolerance of --settle for the
+                        voltage, in V. Default 1e-3 (the laser driver
+                        voltage resolution).''')
+    parser.add_argument('--settle_interval', type=float, default=10e-3,
+                        help='''Time between reads of --settle, in s, so the
+                        instrument bus isn't flooded. Default 0.01.''')
+    parser.add_argument('--settle_timeout', type=float, default=5,
+                        help='''Timeout of --settle per reading, in s.
+                        Default 5.''')
+    parser.add_argument('--cooloff', type=float, default=.5,
+                        help='''Time to wait with the laser off between bias
+                        points, in s. Default 0.5.''')
     parser.add_argument('--wavelength', '-w', type=int, default=650,
                         help='''Wavelenth (for PM100D). Default 650nm.''')
     parser.add_argument('--pulsed', '-p', action='store_true',
@@ -248,4 +436,18 @@ if __name__ == "__main__":
                         - analog out of the PM100D connected to ch4 of the tek.
                         ''')
 
+    parser.add_argument('--full_waveform', action='store_true',
+                        help='''Integration mode: transfer the whole CH4
+                        waveform at each point and average it in python,
+                        instead of reading the mean of the pulse measured
+                        (cursor gated) on the scope.''')
+    parser.add_argument('--verify_every', type=int, default=0,
+                        help='''Integration mode: also transfer the whole
+                        waveform every N points to check the scope's gated
+                        mean (mW_waveform in the results log). Default 0
+                        (never).''')
+    parser.add_argument('--server', nargs='?', const=server.DEFAULT_ADDRESS,
+                        help=f'''Use the instruments of a running
+                        instrument_server instead of connecting to them
+                        (default address {server.DEFAULT_ADDRESS}).''')
     main(parser.parse_args())
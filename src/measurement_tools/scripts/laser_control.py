@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 import argparse
 
-from measurement_tools import interact, LaserDriver
+from measurement_tools import interact, server
 
 
 def run(args):
-    i = LaserDriver()
+    i = server.instruments(args.server).LaserDriver()
     if args.io_max is not None:
         print(f"Setting current limit to {args.io_max} mA")
         i.set_current_limit(args.io_max)
@@ -43,4 +43,8 @@ def main():
                         help='''set Io_max of laser driver''')
     parser.add_argument('--current', '-c', type=int,
                         help='''Set output current (does not raise Io_lim)''')
+    parser.add_argument('--server', nargs='?', const=server.DEFAULT_ADDRESS,
+                        help=f'''Use the instruments of a running
+                        instrument_server instead of connecting to them
+                        (default address {server.DEFAULT_ADDRESS}).''')
     run(parser.parse_args())
@@ -2,14 +2,28 @@
 """
 Alec Vercruysse
 List discovered pyvisa devices and exit.
+
+Devices found by pyvisa, mDNS (LXI) browsing and probing of the known lab
+LAN instruments are cached for --ttl seconds, see discovery.py.
 """
-import pyvisa
+import argparse
 import pprint
 
+from measurement_tools import discovery
+
 
 def main():
-    rm = pyvisa.ResourceManager()
-    pprint.pprint(rm.list_resources())
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--refresh', action='store_true',
+                        help='Ignore the discovery cache and rescan.')
+    parser.add_argument('--ttl', type=float, default=discovery.DEFAULT_TTL,
+                        help='Max age of the discovery cache in s.')
+    parser.add_argument('--timeout', type=float, default=1.,
+                        help='Max mDNS browse time in s.')
+    args = parser.parse_args()
+    pprint.pprint(discovery.list_resources(ttl=args.ttl,
+                                           refresh=args.refresh,
+                                           timeout=args.timeout))
 
 
 if __name__ == '__main__':
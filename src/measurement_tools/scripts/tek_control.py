@@ -1,28 +1,47 @@
 #!/usr/bin/env python3
 import argparse
+import os
 
 import numpy as np
 # import matplotlib.pyplot as plt
 
-from measurement_tools import interact, TekScope
+from measurement_tools import interact, database, server, tek, \
+    waveform_file
 # from tekscope import raw
 
 
 def run(args):
-    i = TekScope()
+    i = server.instruments(args.server).TekScope()
     if args.filename is not None:
-        vs = []
-        wfms = i.retrieve_all_waveforms()
-        t = None
+        wfms = tek.retrieve_all_waveforms(i, args.channel,
+                                          nbytes=args.nbytes)
         for channel in args.channel:
-            wfm = wfms.get(f'CH{channel}')
-            if wfm is not None:
-                if t is None:
-                    t = np.array(wfm.time())
-                vs += [np.array(wfm.voltage())]
-            else:
+            if f'CH{channel}' not in wfms:
                 print(f'Warning: No channel {channel} data.')
-        np.save(args.filename, np.vstack((t, *vs)))
+        wfms = list(wfms.values())
+        if len(wfms) == 0:
+            raise RuntimeError('No waveform data to save.')
+        fname = args.filename
+        if fname.endswith('.npy'):
+            # legacy format: fill the output array in place, instead of
+            # stacking copies.
+            arr = np.empty((1 + len(wfms), len(wfms[0])))
+            wfms[0].time(out=arr[0])
+            for k, wfm in enumerate(wfms):
+                wfm.voltage(out=arr[k + 1])
+            np.save(fname, arr)
+        else:
+            if os.path.splitext(fname)[1] == '':
+                fname += waveform_file.EXTENSION
+            waveform_file.write_waveforms(
+                fname, wfms,
+                settings=tek.acquisition_settings(i, args.channel))
+        print(f'Saved {len(wfms)} channels to {fname}')
+        if not args.no_db:
+            db = database.ResultsDB(args.db)
+            db.start_run(script='tek_control', settings={'tek_control': {
+                'filename': fname, 'channels': args.channel,
+                'nsamples': len(wfms[0]), 'dt': wfms[0].x_incr}})
     if args.reset:
         i.send_raw_command('*RST')  # reset scope
     if args.mode:
@@ -62,7 +81,23 @@ def main():
     parser.add_argument('--hscale', action='store', type=float,
                         help='Set horizontal scale in units of s/div.')
 
-    parser.add_argument('--filename', '-f', help='''output (numpy binary) file.
-    The shape of the numpy array is (<1 + # channels>, <nsamples>), where
+    parser.add_argument('--filename', '-f', help='''output file. By default
+    a compact .mtw file of the raw ADC codes and acquisition settings (see
+    measurement_tools.waveform_file). If the name ends in .npy, a numpy
+    binary file of shape (<1 + # channels>, <nsamples>) instead, where
     arr[0,:] is time and arr[1:,:] are the channel voltage data.''')
-    main(parser.parse_args())
+    parser.add_argument('--nbytes', type=int, default=1, choices=[1, 2],
+                        help='''Bytes per sample to transfer waveforms
+                        with. 2 keeps the extra resolution of averaging or
+                        high-res acquisition modes. Default 1.''')
+    parser.add_argument('--db', default=database.DEFAULT_DB,
+                        help=f'''SQLite results database to record saved
+                        captures in. Default {database.DEFAULT_DB}''')
+    parser.add_argument('--no_db', action='store_true',
+                        help='''Don't record saved captures in the results
+                        database.''')
+    parser.add_argument('--server', nargs='?', const=server.DEFAULT_ADDRESS,
+                        help=f'''Use the instruments of a running
+                        instrument_server instead of connecting to them
+                        (default address {server.DEFAULT_ADDRESS}).''')
+    run(parser.parse_args())
@@ -12,7 +12,7 @@ import sys
 import numpy as np
 import matplotlib.pyplot as plt
 
-from measurement_tools import interact
+from measurement_tools import interact, waveform_file
 
 si_to_mag = {'y': -24,  # yocto
              'z': -21,  # zepto
@@ -36,38 +36,111 @@ si_to_mag = {'y': -24,  # yocto
 mag_to_si = {v: k for k, v in si_to_mag.items()}
 
 
+# samples per channel read and processed at once. Bounds memory use.
+CHUNK = 1 << 20
+# number of points to decimate to.
+MAX_POINTS = 1e5
+
+
+def envelope(x, d):
+    """
+    Min and max of every bucket of `d` samples of `x`, in the order they
+    occur in the bucket, so that peaks narrower than a bucket stay visible.
+    A partial last bucket is padded with its last value.
+
+    Returns:
+    -------
+    np.array of shape (2 * nbuckets,): min/max pairs.
+    """
+    x = np.pad(x, (0, -len(x) % d), mode='edge')
+    buckets = x.reshape(-1, d)
+    imin = buckets.argmin(axis=1)[:, None]
+    imax = buckets.argmax(axis=1)[:, None]
+    lo = np.take_along_axis(buckets, imin, axis=1)
+    hi = np.take_along_axis(buckets, imax, axis=1)
+    min_first = imin <= imax
+    return np.hstack((np.where(min_first, lo, hi),
+                      np.where(min_first, hi, lo))).ravel()
+
+
+def process(wfms, medfilt=-1, decimation_factor=1, mode='envelope',
+            chunk=CHUNK):
+    """
+    Moving average over `medfilt` samples (if not -1) and decimation of
+    every channel of `wfms` (see waveform_file.open_waveforms), reading
+    `chunk` samples at a time (with medfilt - 1 samples of overlap), so that
+    memory use does not depend on the file size.
+
+    mode: how to decimate by `decimation_factor`. 'envelope': the min and
+      max of each bucket of decimation_factor samples (see `envelope`),
+      plotted at the start and middle of the bucket. 'stride': every
+      decimation_factor-th sample, which can miss short glitches.
+
+    Returns:
+    -------
+    (t, v): time, shape (npoints,), and voltages, shape
+    (nchannels, npoints).
+    """
+    if mode not in ('envelope', 'stride'):
+        raise ValueError(f'Unknown decimation mode: {mode}')
+    width = 1 if medfilt == -1 else medfilt
+    cut = (width - 1) // 2
+    d = decimation_factor
+    if d == 1:
+        mode = 'stride'  # nothing to decimate
+    per_bucket = 2 if mode == 'envelope' else 1
+    n_out = len(wfms) - width + 1
+    npoints = -(-n_out // d) * per_bucket
+    t = np.empty(npoints)
+    v = np.empty((len(wfms.channels), npoints))
+    chunk = max(chunk // d, 1) * d  # chunks start at multiples of d
+    for start in range(0, n_out, chunk):
+        stop = min(start + chunk, n_out)
+        first = start // d * per_bucket
+        out = slice(first, first + -(-(stop - start) // d) * per_bucket)
+        tc = wfms.time(start + cut, stop + cut)
+        if mode == 'envelope':
+            idx = np.arange(0, len(tc), d)
+            t[out] = np.column_stack(
+                (tc[idx], tc[np.minimum(idx + d // 2, len(tc) - 1)])).ravel()
+        else:
+            t[out] = tc[::d]
+        for channel in range(len(wfms.channels)):
+            x = wfms.voltage(channel, start, stop + width - 1)
+            if width > 1:
+                x = np.convolve(x, np.ones(width), mode='valid') / width
+            v[channel, out] = envelope(x, d) if mode == 'envelope' \
+                else x[::d]
+    return t, v
+
+
 def run(args):
-    arr = np.load(args.infile)
-    nchannels = arr.shape[0] - 1
+    wfms = waveform_file.open_waveforms(args.infile)
     if args.medfilt != -1:
         assert args.medfilt % 2 == 1
-        newsize = arr.shape[-1] - args.medfilt + 1
-        newarr = np.zeros((nchannels + 1, newsize))
-        cut_amnt = (args.medfilt - 1) // 2
-        newarr[0] = arr[0, cut_amnt:-cut_amnt]
-        for channel in range(nchannels):
-            newarr[channel+1] = np.convolve(
-                arr[channel+1], np.ones(args.medfilt),
-                mode='valid') / args.medfilt
-        arr = newarr
+    n = len(wfms) - (args.medfilt - 1 if args.medfilt != -1 else 0)
     # check how many samples and decimate if necessary (for speed):
-    decimation_factor = int(np.ceil(arr.shape[-1] / 1e5))
+    per_bucket = 2 if args.decimation_mode == 'envelope' else 1
+    decimation_factor = int(np.ceil(n * per_bucket / MAX_POINTS))
     if decimation_factor > 2 and not args.no_decimation:
-        print(f'Original data has {arr.shape[-1]} points. ' +
+        print(f'Original data has {n} points. ' +
               f'Decimating by {decimation_factor}x.')
-        arr = arr[:, ::decimation_factor]
+    else:
+        decimation_factor = 1
+    t, v = process(wfms, args.medfilt, decimation_factor,
+                   mode=args.decimation_mode)
     if args.outfile is None:
         plt.ion()
     # horizontal axis
-    time_mag = int(np.floor(np.log10(arr[0, -1]) / 3) * 3)
+    time_mag = int(np.floor(np.log10(t[-1]) / 3) * 3)
     plt.xlabel(f'Time [{mag_to_si[time_mag]}s]')
 
     # vertical axis
     plt.ylabel('Voltage [V]')
 
     # plot
-    plt.plot(arr[0, :, None] * np.ones((1, nchannels)) * (10**-time_mag),
-             arr[1:].T)
+    # (the time vector is broadcast against every channel by matplotlib)
+    plt.plot(t * (10**-time_mag), v.T)
     plt.grid(visible=True)
 
     if args.labels:
@@ -87,12 +160,13 @@ def main():
     parser = argparse.ArgumentParser(
         prog='tek-plot.py',
         description='''Start a (potentially interactive) environment to plot a
-        .npy file saved by `tek_control`. Decimates if necesssary to
+        .mtw or .npy file saved by `tek_control`. Decimates if necesssary to
         plot ~1e5 samples.
         ''',
         epilog="Contact: alecfv@berkeley.edu"
     )
-    parser.add_argument('infile', help='.npy file containing waveform data.')
+    parser.add_argument('infile',
+                        help='.mtw or .npy file containing waveform data.')
     parser.add_argument('--title', '-t', type=str, help='''Title of plot.
     Defaults to <infile>.''')
     parser.add_argument('--labels', '-l',
@@ -104,8 +178,14 @@ def main():
     parser.add_argument('--no_decimation', '-n', action='store_true',
                         help='''Don't decimate to ~10e5 samples
                         no matter what (slow).''')
+    parser.add_argument('--decimation_mode', default='envelope',
+                        choices=['envelope', 'stride'],
+                        help='''envelope: plot the min and max of each
+                        group of samples, so glitches and edges stay
+                        visible. stride: plot every N-th sample (can miss
+                        short features). Default envelope.''')
 
     parser.add_argument('--outfile', '-o', default=None, help='''
     Output file name. Generates an interactive matplotlib figure
     if this is not specified.''')
-    main(parser.parse_args())
+    run(parser.parse_args())
@@ -0,0 +1,387 @@
+"""
+Optional long-lived instrument server.
+
+The server (see the `instrument_server` script) owns the instrument
+connections, so short scripts can attach to already open instruments in
+milliseconds instead of reconnecting (and re-running e.g. the LaserDriver
+*IDN? dance) every time. Clients talk to it over TCP loopback (or a Unix
+socket) with `connect()`, which mirrors the factories of this package:
+
+    instruments = server.connect()
+    i = instruments.LaserDriver()
+    i.set_output_current(10)
+    f = instruments.Agilent33500BFnGen()
+    f.channels[2].output = False
+
+Attribute access, item access and method calls are forwarded to the server.
+Numbers, strings, numpy arrays (and lists/tuples/dicts of those) come back
+by value; anything else (channels, waveform objects, ...) comes back as
+another remote proxy. Access to each instrument is serialized on the
+server. Interactive prompts (e.g. choosing a VISA ID, confirming a raised
+laser current limit) appear in the server's terminal.
+
+Safety: the LaserDriver is disabled when the server exits, and by default
+also whenever the last client disconnects, like it is when a script that
+owns it exits.
+
+Security: the protocol is pickle based, so whoever can connect can run
+code as the server's user. Connections are authenticated with a random
+key generated on the first start and stored in AUTHKEY_FILE (readable by
+the user only), which clients read; Unix sockets are created user-only
+too. The server only listens on loopback addresses unless `allow_remote`.
+"""
+import inspect
+import ipaddress
+import itertools
+import os
+import secrets
+import signal
+import socket
+import sys
+import threading
+from multiprocessing.connection import Client as _Client, Listener
+
+import numpy as np
+
+DEFAULT_ADDRESS = 'localhost:18861'
+AUTHKEY_FILE = os.path.join(
+    os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config'),
+    'measurement_tools', 'server_authkey')
+FACTORIES = ['LaserDriver', 'OpticalPowerMeter', 'Agilent33500BFnGen',
+             'AgilentE5062AVNA', 'TekScope', 'PSMU']
+
+
+def parse_address(address):
+    """
+    'host:port' -> (host, port) for TCP. Anything else is used as a Unix
+    socket path.
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host, int(port))
+    return address
+
+
+def is_loopback(address):
+    """
+    Whether the parsed `address` is a Unix socket or a TCP address that
+    only resolves to loopback interfaces ('' means all interfaces).
+    """
+    if isinstance(address, str):
+        return True
+    host, port = address
+    if host == '':
+        return False
+    try:
+        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(info[4][0].split('%')[0]).is_loopback
+               for info in infos)
+
+
+def load_authkey(fname=AUTHKEY_FILE, create=False):
+    """
+    The key clients authenticate to the server with. With `create`, a random
+    key is generated and stored in `fname` (mode 0600) if there is none yet.
+    """
+    if create and not os.path.exists(fname):
+        os.makedirs(os.path.dirname(fname), mode=0o700, exist_ok=True)
+        try:
+            fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:  # another server created it meanwhile
+            pass
+        else:
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(32))
+    try:
+        with open(fname) as f:
+            return f.read().strip().encode('ascii')
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            f'No instrument server key in {fname}: start instrument_server '
+            '(as this user) first.') from None
+
+
+class InstrumentServer:
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None,
+                 disable_on_idle=True, allow_remote=False):
+        """
+        Parameters:
+        ----------
+        address: 'host:port' or Unix socket path to listen on.
+        authkey: key clients need. Default: `load_authkey(create=True)`.
+        disable_on_idle: disable the LaserDriver output when the last client
+          disconnects.
+        allow_remote: allow listening on non-loopback addresses. The
+          protocol is pickle based: anyone who has the key can run code on
+          this machine.
+        """
+        self.address = parse_address(address)
+        if not allow_remote and not is_loopback(self.address):
+            raise ValueError(f'{address} is not a loopback address; pass '
+                             'allow_remote to listen on it anyway.')
+        self.authkey = load_authkey(create=True) if authkey is None \
+            else authkey
+        self.disable_on_idle = disable_on_idle
+        self.instruments = {}  # (factory, name) -> (instrument, lock)
+        self.lock = threading.Lock()
+        self.nclients = 0
+        self._method_names = {}
+
+    def serve_forever(self):
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)  # stale socket of a previous server
+        umask = os.umask(0o177)  # Unix socket only accessible by this user
+        try:
+            listener = Listener(self.address, authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        with listener:
+            print(f'Instrument server listening on {self.address}')
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:  # e.g. failed authentication
+                    print(f'Rejected connection: {e}')
+                    continue
+                threading.Thread(target=self._serve_client, args=(conn,),
+                                 daemon=True).start()
+
+    def open(self, factory, kwargs):
+        """
+        Return (instrument, lock), connecting on first use. Instruments are
+        shared by all clients, keyed by factory and resource name.
+        """
+        if factory not in FACTORIES:
+            raise ValueError(f'Unknown instrument factory {factory}')
+        key = (factory, kwargs.get('name', kwargs.get('host_id')))
+        with self.lock:
+            if key not in self.instruments:
+                import measurement_tools
+                instr = getattr(measurement_tools, factory)(**kwargs)
+                self.instruments[key] = (instr, threading.RLock())
+                return self.instruments[key]
+        instr, lock = self.instruments[key]
+        if kwargs.get('cached'):
+            # a new script: don't trust settings cached during earlier ones
+            # (the instrument may have been changed, or raw SCPI sent).
+            from . import caching
+            with lock:
+                caching.invalidate(instr)
+        if factory == 'LaserDriver':
+            # limits are the only per-script LaserDriver arguments.
+            with lock:
+                if kwargs.get('Io_max') is not None:
+                    instr.set_current_limit(kwargs['Io_max'])
+                if kwargs.get('Vf_max') is not None:
+                    instr.set_voltage_limit(kwargs['Vf_max'])
+        return instr, lock
+
+    def _serve_client(self, conn):
+        refs = {}  # ref id -> (object, lock of the instrument it belongs to)
+        ids = itertools.count()
+        with self.lock:
+            self.nclients += 1
+        try:
+            while True:
+                try:
+                    released, request = conn.recv()
+                except (EOFError, OSError):
+                    break
+                for ref in released:
+                    refs.pop(ref, None)
+                try:
+                    response = ('ok', self._dispatch(refs, ids, *request))
+                except Exception as e:
+                    response = ('error', e)
+                try:
+                    conn.send(response)
+                except Exception as e:  # e.g. unpicklable exception
+                    conn.send(('error', RuntimeError(repr(response[1]))))
+        finally:
+            conn.close()
+            with self.lock:
+                self.nclients -= 1
+                idle = self.nclients == 0
+            if idle and self.disable_on_idle:
+                self._disable_lasers()
+
+    def _dispatch(self, refs, ids, op, *args):
+        if op == 'open':
+            instr, lock = self.open(*args)
+            return self._export(refs, ids, instr, lock)
+        obj, lock = refs[args[0]]
+        with lock:
+            if op == 'getattr':
+                value = getattr(obj, args[1])
+            elif op == 'setattr':
+                setattr(obj, args[1], args[2])
+                return None
+            elif op == 'getitem':
+                value = obj[args[1]]
+            elif op == 'setitem':
+                obj[args[1]] = args[2]
+                return None
+            elif op == 'call':
+                value = obj(*args[1], **args[2])
+            elif op == 'callmethod':
+                value = getattr(obj, args[1])(*args[2], **args[3])
+            else:
+                raise ValueError(f'Unknown request {op}')
+        return self._export(refs, ids, value, lock)
+
+    def _export(self, refs, ids, value, lock):
+        if _is_value(value):
+            return ('value', value)
+        ref = next(ids)
+        refs[ref] = (value, lock)
+        return ('ref', ref, type(value).__name__,
+                self._methods(type(value)))
+
+    def _methods(self, cls):
+        """
+        Names of the methods of `cls`, so that clients can call them in one
+        round trip instead of fetching the bound method first.
+        """
+        if cls not in self._method_names:
+            self._method_names[cls] = frozenset(
+                name for name, attr in inspect.getmembers(cls)
+                if callable(attr) and not name.startswith('__')
+                and not isinstance(attr, type))
+        return self._method_names[cls]
+
+    def _disable_lasers(self):
+        for (factory, _), (instr, lock) in list(self.instruments.items()):
+            if factory == 'LaserDriver':
+                with lock:
+                    instr.disable_output()
+
+
+def _is_value(value):
+    if value is None or isinstance(
+            value, (bool, int, float, complex, str, bytes,
+                    np.ndarray, np.generic)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(_is_value(v) for v in value)
+    if isinstance(value, dict):
+        return all(_is_value(k) and _is_value(v) for k, v in value.items())
+    return False
+
+
+class InstrumentClient:
+    """
+    Connection to an `InstrumentServer`. Has one method per factory of
+    this package (LaserDriver, OpticalPowerMeter, ...) returning a remote
+    proxy of the server's instrument.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        if authkey is None:
+            authkey = load_authkey()
+        self.conn = _Client(parse_address(address), authkey=authkey)
+        self.lock = threading.Lock()
+        # refs of garbage collected proxies, released with the next request
+        # (releasing from __del__ directly could deadlock on self.lock).
+        self.released = []
+
+    def request(self, *request):
+        with self.lock:
+            released, self.released = self.released, []
+            self.conn.send((released, request))
+            status, payload = self.conn.recv()
+        if status == 'error':
+            raise payload
+        if payload is None or payload[0] == 'value':
+            return None if payload is None else payload[1]
+        _, ref, typename, methods = payload
+        return RemoteObject(self, ref, typename, methods)
+
+    def open(self, factory, **kwargs):
+        return self.request('open', factory, kwargs)
+
+    def close(self):
+        self.conn.close()
+
+    def __getattr__(self, name):
+        if name in FACTORIES:
+            return lambda **kwargs: self.open(name, **kwargs)
+        raise AttributeError(name)
+
+
+class RemoteObject:
+    """
+    Proxy of an object living in the instrument server.
+    """
+
+    def __init__(self, client, ref, typename, methods):
+        object.__setattr__(self, '_client', client)
+        object.__setattr__(self, '_ref', ref)
+        object.__setattr__(self, '_typename', typename)
+        object.__setattr__(self, '_methods', methods)
+
+    def __getattr__(self, name):
+        if name in self._methods:
+            return _RemoteMethod(self, name)
+        return self._client.request('getattr', self._ref, name)
+
+    def __setattr__(self, name, value):
+        self._client.request('setattr', self._ref, name, value)
+
+    def __getitem__(self, key):
+        return self._client.request('getitem', self._ref, key)
+
+    def __setitem__(self, key, value):
+        self._client.request('setitem', self._ref, key, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._client.request('call', self._ref, args, kwargs)
+
+    def __dir__(self):
+        return sorted(self._methods)
+
+    def __repr__(self):
+        return f'<remote {self._typename} #{self._ref}>'
+
+    def __del__(self):
+        self._client.released.append(self._ref)
+
+
+class _RemoteMethod:
+    def __init__(self, obj, name):
+        self.obj = obj
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        return self.obj._client.request('callmethod', self.obj._ref,
+                                        self.name, args, kwargs)
+
+
+def connect(address=DEFAULT_ADDRESS, authkey=None):
+    """
+    Connect to a running instrument server. See the module docstring.
+    """
+    return InstrumentClient(address, authkey=authkey)
+
+
+def instruments(address=None):
+    """
+    Where scripts get their instruments from: a client of the server at
+    `address`, or (if None) this package itself. Both have the same factory
+    functions, e.g. `instruments(args.server).LaserDriver()`.
+    """
+    if address is None:
+        import measurement_tools
+        return measurement_tools
+    return connect(address)
+
+
+def serve(address=DEFAULT_ADDRESS, disable_on_idle=True, allow_remote=False):
+    """
+    Run a server until interrupted. SIGTERM exits cleanly too, so the
+    LaserDriver atexit shutdown runs.
+    """
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    InstrumentServer(address, disable_on_idle=disable_on_idle,
+                     allow_remote=allow_remote).serve_forever()
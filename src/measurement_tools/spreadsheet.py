@@ -1,9 +1,12 @@
+import glob
 import os
+import re
+from datetime import datetime
 
 import pandas as pd
 
 
-def add_to_spreadsheet(fname, df, **kwargs):
+def add_to_spreadsheet(fname, df, incremental=False, **kwargs):
     """
     Note that the kwargs are passed to both
     the read and write fn of the spreadsheet.
@@ -12,20 +15,49 @@ def add_to_spreadsheet(fname, df, **kwargs):
     Creates a spreadsheet if one does not exist.
 
     Replaces columns if they already exist.
+
+    If `incremental` is True, the file itself is not touched. Instead, `df`
+    is written to a small .csv "part" next to it (see `parts_dir`), so the
+    cost only depends on the size of `df`. `read_spreadsheet` merges the
+    parts on read, and `consolidate_spreadsheet` folds them into the file.
     """
-    if os.path.exists(fname):
-        old_df = read_spreadsheet(fname, **kwargs)
-        duplicate_columns = set(old_df.columns).intersection(df.columns)
-        df = old_df.join(df, how='outer', lsuffix='_todelete')
-        if len(duplicate_columns) > 0:
-            df = df.drop(columns=[f'{c}_todelete' for c in duplicate_columns])
+    if incremental:
+        write_part(fname, df, sheet_name=kwargs.get('sheet_name'))
+        return
+    if os.path.exists(fname) or len(list_parts(fname, **kwargs)) > 0:
+        df = merge_columns(read_spreadsheet(fname, **kwargs), df)
     write_spreadsheet(fname, df, **kwargs)
+    remove_parts(fname, **kwargs)
 
 
-def read_spreadsheet(fname, **kwargs):
-    extension = os.path.splitext(fname)[1]
-    fn = pd.read_csv if extension == ".csv" else pd.read_excel
-    return fn(fname, **kwargs)
+def merge_columns(old_df, df):
+    """
+    Outer join of `df` onto `old_df`, where columns of `df` replace
+    columns of `old_df` with the same name.
+    """
+    duplicate_columns = set(old_df.columns).intersection(df.columns)
+    df = old_df.join(df, how='outer', lsuffix='_todelete')
+    if len(duplicate_columns) > 0:
+        df = df.drop(columns=[f'{c}_todelete' for c in duplicate_columns])
+    return df
+
+
+def read_spreadsheet(fname, merge_parts=True, **kwargs):
+    """
+    Reads the spreadsheet and, if `merge_parts`, any parts appended with
+    `add_to_spreadsheet(..., incremental=True)` (in the order they were
+    written). The file itself does not need to exist if there are parts.
+    """
+    parts = list_parts(fname, **kwargs) if merge_parts else []
+    if os.path.exists(fname) or len(parts) == 0:
+        extension = os.path.splitext(fname)[1]
+        fn = pd.read_csv if extension == ".csv" else pd.read_excel
+        df = fn(fname, **kwargs)
+    else:
+        df = pd.DataFrame()
+    for part in parts:
+        df = merge_columns(df, pd.read_csv(part))
+    return df
 
 
 def write_spreadsheet(fname, df, **kwargs):
@@ -35,3 +67,72 @@ def write_spreadsheet(fname, df, **kwargs):
     extension = os.path.splitext(fname)[1]
     fn = df.to_csv if extension == ".csv" else df.to_excel
     fn(fname, index=False)
+
+
+def parts_dir(fname, sheet_name=None):
+    """
+    Directory holding the incrementally appended parts of `fname`.
+    """
+    d = f'{fname}.parts'
+    if sheet_name is not None:
+        d = os.path.join(d, str(sheet_name))
+    return d
+
+
+def write_part(fname, df, sheet_name=None):
+    """
+    Write `df` as a new part of `fname`. Parts are named by timestamp and a
+    counter (for parts within the same microsecond) so that they sort in
+    the order they were written.
+    """
+    d = parts_dir(fname, sheet_name=sheet_name)
+    os.makedirs(d, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    n = 0
+    part = os.path.join(d, f'{stamp}_{n:03d}.csv')
+    while os.path.exists(part):
+        n += 1
+        part = os.path.join(d, f'{stamp}_{n:03d}.csv')
+    # write to a temp file first so a crash never leaves a partial part.
+    df.to_csv(part + '.tmp', index=False)
+    os.replace(part + '.tmp', part)
+    return part
+
+
+def _part_order(part):
+    """
+    Sort key (timestamp, counter) of a part file name. Also parses the
+    <stamp>.csv / <stamp>-<n>.csv names of older versions.
+    """
+    name = os.path.splitext(os.path.basename(part))[0]
+    match = re.fullmatch(r'(\d{8}-\d{6}-\d{6})(?:[-_](\d+))?', name)
+    if match is None:
+        return (name, 0)
+    return (match.group(1), int(match.group(2) or 0))
+
+
+def list_parts(fname, sheet_name=None, **kwargs):
+    """
+    Parts of `fname`, in the order they were written.
+    """
+    return sorted(glob.glob(os.path.join(
+        parts_dir(fname, sheet_name=sheet_name), '*.csv')), key=_part_order)
+
+
+def remove_parts(fname, sheet_name=None, **kwargs):
+    for part in list_parts(fname, sheet_name=sheet_name):
+        os.remove(part)
+    for d in [parts_dir(fname, sheet_name=sheet_name), parts_dir(fname)]:
+        if os.path.isdir(d) and len(os.listdir(d)) == 0:
+            os.rmdir(d)
+
+
+def consolidate_spreadsheet(fname, **kwargs):
+    """
+    Fold all incrementally appended parts into the spreadsheet itself,
+    e.g. before sharing it. This is a full rewrite.
+    """
+    if len(list_parts(fname, **kwargs)) == 0:
+        return
+    write_spreadsheet(fname, read_spreadsheet(fname, **kwargs), **kwargs)
+    remove_parts(fname, **kwargs)
@@ -0,0 +1,289 @@
+"""
+Helpers for Tektronix 3-series scopes (see `wrappers.TekScope`) that talk
+SCPI directly over the scope's socket (`scope.soc`), for things the
+tekscope package does not do (fast): on-scope measurements, and binary
+waveform transfers.
+
+Usage:
+-----
+s = TekScope()
+tek.setup_gated_mean(s, 'CH4', 0, 50e-3)
+... trigger ...
+mean = tek.read_measurement(s)  # one number instead of the whole waveform
+
+wfm = tek.retrieve_waveform(s, 'CH1')  # raw ADC codes, 1-2 bytes/sample
+v = wfm.voltage()
+
+The binary transfers receive straight into numpy arrays. With the TekScope
+of an instrument_server, each block is instead received on the server and
+sent over as bytes in one round trip.
+"""
+import socket
+
+import numpy as np
+
+# MEASUrement:MEAS<x>:VALue? when there is no valid measurement (e.g. the
+# scope did not trigger since CLEAR).
+NO_MEASUREMENT = 9e37
+
+
+def write(scope, command):
+    scope.soc.sendall(command.encode('ascii') + b'\n')
+
+
+def read_line(scope):
+    """
+    Read one newline terminated response.
+    """
+    chunks = []
+    while True:
+        chunk = scope.soc.recv(4096)
+        if len(chunk) == 0:
+            raise ConnectionError('Scope closed the connection.')
+        chunks.append(chunk)
+        if chunk.endswith(b'\n'):
+            return b''.join(chunks)
+
+
+def query(scope, command):
+    write(scope, command)
+    return read_line(scope).decode('ascii').strip()
+
+
+def setup_gated_mean(scope, source='CH4', start=0., stop=50e-3, meas=1):
+    """
+    Configure measurement slot `meas` as the mean of `source` between
+    `start` and `stop` (s, relative to the trigger), gated with the
+    vertical bar cursors. Read it with `read_measurement`.
+    """
+    for command in [
+            'HEADer OFF',  # on after *RST: replies would start with ':MEAS..'
+            f'MEASUrement:MEAS{meas}:TYPe MEAN',
+            f'MEASUrement:MEAS{meas}:SOUrce1 {source}',
+            f'MEASUrement:MEAS{meas}:STATE ON',
+            'CURSor:FUNCtion WAVEform',
+            f'CURSor:SOUrce {source}',
+            f'CURSor:VBArs:POSITION1 {start:.6E}',
+            f'CURSor:VBArs:POSITION2 {stop:.6E}',
+            'MEASUrement:GATing CURSor']:
+        write(scope, command)
+
+
+def read_measurement(scope, meas=1):
+    """
+    Value of measurement slot `meas`, or NaN if there is none (e.g. the
+    scope did not trigger).
+    """
+    # (the value is the last token, also if headers are on)
+    value = float(query(scope, f'MEASUrement:MEAS{meas}:VALue?').split()[-1])
+    return float('nan') if abs(value) >= NO_MEASUREMENT else value
+
+
+class Waveform:
+    """
+    A channel capture as the scope's raw ADC codes, and the scaling to get
+    volts and seconds. Same `time()` / `voltage()` interface as the
+    tekscope waveforms, but they are computed on demand.
+
+    Attributes:
+    ----------
+    codes: np.array of int8 or (big endian) int16 ADC codes.
+    x_zero, x_incr: time of the first sample and sample interval, in s.
+    y_mult, y_off, y_zero: volts = (codes - y_off) * y_mult + y_zero.
+    source: e.g. 'CH1'.
+    """
+
+    def __init__(self, codes, x_zero, x_incr, y_mult, y_off, y_zero,
+                 source=None):
+        self.codes = codes
+        self.x_zero = x_zero
+        self.x_incr = x_incr
+        self.y_mult = y_mult
+        self.y_off = y_off
+        self.y_zero = y_zero
+        self.source = source
+
+    def __len__(self):
+        return len(self.codes)
+
+    def voltage(self, out=None):
+        """
+        Samples in V, as float64 (written into `out` if given).
+        """
+        out = np.subtract(self.codes, self.y_off, out=out, dtype=np.float64)
+        out *= self.y_mult
+        out += self.y_zero
+        return out
+
+    def time(self, out=None):
+        """
+        Sample times in s, relative to the trigger.
+        """
+        out = np.multiply(np.arange(len(self.codes)), self.x_incr, out=out)
+        out += self.x_zero
+        return out
+
+    def index(self, t):
+        """
+        Index of the first sample at time >= t.
+        """
+        # (tolerate rounding, t is usually a multiple of x_incr)
+        k = int(np.ceil((t - self.x_zero) / self.x_incr - 1e-6))
+        return min(max(k, 0), len(self.codes))
+
+    def mean(self, t0=None, t1=None):
+        """
+        Mean voltage of the samples with t0 <= t < t1 (s), computed on
+        the codes without building the time or voltage arrays.
+        """
+        start = 0 if t0 is None else self.index(t0)
+        stop = len(self.codes) if t1 is None else self.index(t1)
+        if stop <= start:
+            return float('nan')
+        code = self.codes[start:stop].mean(dtype=np.float64)
+        return (code - self.y_off) * self.y_mult + self.y_zero
+
+
+def recv_exactly(scope, buf):
+    """
+    Fill the writable buffer `buf` (bytearray, numpy array, ...) from the
+    socket, without intermediate copies.
+    """
+    view = memoryview(buf).cast('B')
+    soc = scope.soc
+    local = isinstance(soc, socket.socket)
+    while len(view) > 0:
+        if local:
+            n = soc.recv_into(view)
+        else:
+            # socket of an instrument_server (memoryviews can't be sent).
+            data = soc.recv(len(view), socket.MSG_WAITALL)
+            n = len(data)
+            view[:n] = data
+        if n == 0:
+            raise ConnectionError('Scope closed the connection.')
+        view = view[n:]
+
+
+def read_binary_block(scope, dtype, out=None):
+    """
+    Read an IEEE 488.2 definite length block (#<n><length><data><LF>) of
+    `dtype` values. The data is received directly into `out` (a 1D numpy
+    array of `dtype` that is large enough), or into a new array.
+
+    Returns:
+    -------
+    np.array: view of `out` with the received values.
+    """
+    header = bytearray(2)
+    recv_exactly(scope, header)
+    if header[:1] != b'#':
+        raise ValueError(f'Expected a binary block, got {bytes(header)}')
+    length = bytearray(int(header[1:2]))
+    recv_exactly(scope, length)
+    nbytes = int(length)
+    dtype = np.dtype(dtype)
+    n = nbytes // dtype.itemsize
+    if out is None:
+        out = np.empty(n, dtype=dtype)
+    elif out.dtype != dtype or len(out) < n:
+        raise ValueError(f'out must hold {n} values of type {dtype}')
+    recv_exactly(scope, out[:n])
+    recv_exactly(scope, bytearray(1))  # terminating newline
+    return out[:n]
+
+
+def setup_binary_transfer(scope, nbytes=1):
+    """
+    Make CURVe? send signed big endian integers of `nbytes` (1 or 2) bytes,
+    the whole record, and queries answer without headers.
+    """
+    if nbytes not in (1, 2):
+        raise ValueError('nbytes must be 1 or 2')
+    # (without HEADer OFF first, the reply is ':HORIZONTAL:RECORDLENGTH n')
+    write(scope, 'HEADer OFF')
+    record_length = int(query(scope, 'HORizontal:RECOrdlength?'))
+    for command in ['DATa:ENCdg RIBinary', f'WFMOutpre:BYT_Nr {nbytes}',
+                    'DATa:STARt 1', f'DATa:STOP {record_length}']:
+        write(scope, command)
+
+
+def retrieve_waveform(scope, source='CH1', nbytes=None, out=None):
+    """
+    Transfer the waveform of `source` (e.g. 'CH4') in binary. Call
+    `setup_binary_transfer` first (once; or pass `nbytes` to do it here).
+
+    Parameters:
+    ----------
+    nbytes: 1 (8 bit ADC codes) or 2 (more resolution with averaging or
+      high-res acquisition modes).
+    out: preallocated numpy array of int8 / '>i2' to receive into, e.g. the
+      `codes` of a previous Waveform, to avoid allocations when capturing
+      repeatedly.
+
+    Returns:
+    -------
+    Waveform, or None if `source` is not displayed or has no data.
+    """
+    if nbytes is not None:
+        setup_binary_transfer(scope, nbytes)
+    if source.upper().startswith('CH') and \
+            query(scope, f'SELect:{source}?') != '1':
+        return None
+    write(scope, f'DATa:SOUrce {source}')
+    preamble = query(scope, 'WFMOutpre:BYT_Nr?;XINcr?;XZEro?;YMUlt?;'
+                            'YOFf?;YZEro?')
+    byt_nr, x_incr, x_zero, y_mult, y_off, y_zero = \
+        [float(v) for v in preamble.split(';')]
+    dtype = np.int8 if byt_nr == 1 else np.dtype('>i2')
+    write(scope, 'CURVe?')
+    codes = read_binary_block(scope, dtype, out=out)
+    if len(codes) == 0:
+        return None
+    return Waveform(codes, x_zero, x_incr, y_mult, y_off, y_zero,
+                    source=source)
+
+
+def retrieve_all_waveforms(scope, channels=(1, 2, 3, 4), nbytes=1):
+    """
+    Binary transfer of every displayed channel.
+
+    Returns:
+    -------
+    dict {'CH<n>': Waveform}
+    """
+    setup_binary_transfer(scope, nbytes)
+    wfms = {}
+    for channel in channels:
+        wfm = retrieve_waveform(scope, f'CH{channel}')
+        if wfm is not None:
+            wfms[f'CH{channel}'] = wfm
+    return wfms
+
+
+def acquisition_settings(scope, channels=(1, 2, 3, 4)):
+    """
+    Horizontal, acquisition, trigger and channel settings, to store with a
+    capture. Numbers are returned as floats, the rest as strings.
+    """
+    queries = {
+        'horizontal_scale': 'HORizontal:SCAle?',
+        'horizontal_position': 'HORizontal:POSition?',
+        'record_length': 'HORizontal:RECOrdlength?',
+        'acquire_mode': 'ACQuire:MODe?',
+        'acquire_numavg': 'ACQuire:NUMAVg?',
+        'trigger_mode': 'TRIGger:A:MODe?',
+    }
+    for channel in channels:
+        for name in ['SCAle', 'OFFSet', 'POSition', 'COUPling', 'BANdwidth',
+                     'TERmination']:
+            queries[f'CH{channel}_{name.lower()}'] = f'CH{channel}:{name}?'
+    write(scope, 'HEADer OFF')
+    settings = {}
+    for name, command in queries.items():
+        value = query(scope, command)
+        try:
+            settings[name] = float(value)
+        except ValueError:
+            settings[name] = value
+    return settings
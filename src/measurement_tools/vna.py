@@ -3,50 +3,149 @@
 #
 # Utility functions for the lab VNA (agilentE5062A) that aren't fit for the
 # pymeasure class.
+#
+# Settings are written through a shadow-state cache (see caching.py), so
+# repeated calls only send the settings that changed. Use
+# caching.invalidate(vna) after changing settings on the front panel.
+
+import logging
+import queue
+import threading
+import time
 
 import skrf.network
 import numpy as np
 import measurement_tools
+from measurement_tools import caching
 from pyvisa.errors import VisaIOError
 from pathlib import Path
 
+log = logging.getLogger(__name__)
+
 
-def construct_network(channel):
+S_PARAMETERS = ["S11", "S12", "S21", "S22"]
+
+
+def construct_network(channel, fast=True):
     """Given a channel of an AgilentE5062A, measure all S-parameters of the
     network and return an skrf.network.Network object.
 
     Assumes the sweep settings have been set.
 
+    If `fast`, the corrected data of all four traces is read in binary (see
+    `read_s_matrix`), otherwise each trace is activated, formatted as polar
+    and read in ASCII through the pymeasure API.
+
     TODO does changing the trace value restart a sweep/clear averaging? Should
     we be waiting for averaging in this method?
 
     """
-    freqs = channel.frequencies
-    s_matrix = np.empty((freqs.size, 4), dtype=np.complex64)
-    channel.visible_traces = 4
-    for i, (tr, parameter) in enumerate(
-        zip(channel.traces.values(), ["S11", "S12", "S21", "S22"])
-    ):
-        tr.parameter = parameter
-        tr.activate()
-        channel.trace_format = "POL"
-        re, im = channel.data
-        s_matrix[:, i] = re + 1j * im
+    start = time.perf_counter()
+    if fast:
+        freqs, s_matrix = read_s_matrix(channel)
+    else:
+        freqs = channel.frequencies
+        s_matrix = np.empty((freqs.size, 4), dtype=np.complex64)
+        channel.visible_traces = 4
+        for i, (tr, parameter) in enumerate(
+            zip(channel.traces.values(), S_PARAMETERS)
+        ):
+            tr.parameter = parameter
+            tr.activate()
+            channel.trace_format = "POL"
+            re, im = channel.data
+            s_matrix[:, i] = re + 1j * im
+    log.debug(f"construct_network(fast={fast}) took "
+              f"{time.perf_counter() - start:.3f} s")
     return skrf.network.Network(f=freqs, s=s_matrix.reshape(-1, 2, 2), z0=50)
 
 
+def read_s_matrix(channel, binary=True):
+    """Read the frequencies and the corrected S11, S12, S21, S22 data of a
+    channel of an AgilentE5062A with as few transfers as possible.
+
+    The four traces are defined in one message (invalidating the settings
+    cache of the channel, see caching.py), and each trace is read with
+    :CALC:DATA:SDAT? (corrected complex data, independent of the trace
+    format, so no per-trace reformatting is needed). If `binary`, the data
+    is transferred as REAL64 blocks; if the instrument rejects that, this
+    falls back to ASCII.
+
+    Returns:
+    -------
+    freqs: np.array, shape (npoints,)
+    s_matrix: complex np.array, shape (npoints, 4)
+
+    """
+    vna = channel.parent
+    ch = channel.id
+    vna.write(
+        f":CALC{ch}:PAR:COUN 4;"
+        + ";".join(f":CALC{ch}:PAR{n}:DEF {param}"
+                   for n, param in enumerate(S_PARAMETERS, start=1))
+    )
+    # (written directly, so the settings cache of the channel and its traces
+    # is out of date)
+    caching.invalidate(caching.cached(vna).channels[ch])
+    if binary:
+        try:
+            return _read_s_matrix(vna, ch, binary=True)
+        except (VisaIOError, ValueError) as e:
+            log.warning(f"Binary transfer failed ({e}), falling back to ASCII")
+            vna.clear()
+    return _read_s_matrix(vna, ch, binary=False)
+
+
+def _read_s_matrix(vna, ch, binary):
+    conn = vna.adapter.connection
+    if binary:
+        vna.write(":FORM:DATA REAL;:FORM:BORD NORM")
+
+        def query(cmd):
+            return conn.query_binary_values(
+                cmd, datatype="d", is_big_endian=True, container=np.array
+            )
+
+    else:
+        vna.write(":FORM:DATA ASC")
+
+        def query(cmd):
+            return conn.query_ascii_values(cmd, container=np.array)
+
+    try:
+        freqs = query(f":SENS{ch}:FREQ:DATA?")
+        s_matrix = np.empty((freqs.size, 4), dtype=np.complex128)
+        for n in range(1, 5):
+            data = query(f":CALC{ch}:PAR{n}:SEL;:CALC{ch}:DATA:SDAT?")
+            data = np.ascontiguousarray(data, dtype=np.float64)
+            s_matrix[:, n - 1] = data.view(np.complex128)  # (re, im) pairs
+    finally:
+        if binary:
+            vna.write(":FORM:DATA ASC")  # what the pymeasure API expects
+    return freqs, s_matrix
+
+
 def monitor_vna_err_queue(routine):
     """Double check the the VNA threw no errors. Requires the VNA object to be
     the first argument to the wrapped funtion
 
+    On errors, the settings cache of the VNA (see `measurement_tools.caching`)
+    is invalidated.
+
     """
 
     def new_routine(vna, *args, **kwargs):
         vna.clear()
-        routine(vna, *args, **kwargs)
+        try:
+            ret = routine(vna, *args, **kwargs)
+        except BaseException:
+            caching.invalidate(vna)  # don't trust the settings cache anymore
+            raise
         code, msg = vna.pop_err()
         if code != 0:
+            caching.invalidate(vna)
             raise IOError(f"VNA threw error code {code}: {msg}")
+        return ret
 
     return new_routine
 
@@ -54,6 +153,7 @@ def monitor_vna_err_queue(routine):
 @monitor_vna_err_queue
 def setup_vna_for_cal(vna, fstart=300e3, fstop=100e6, f_IF=1e3):
     """Requires a new cal when this is called! (and it changes settings)"""
+    vna = caching.cached(vna)
     ch = vna.channels[1]  # choose channel 1
     ch.start_frequency = fstart  # 300 kHz (lower bound)
     ch.stop_frequency = fstop  # 100 MHz default
@@ -64,44 +164,137 @@ def setup_vna_for_cal(vna, fstart=300e3, fstop=100e6, f_IF=1e3):
     input("VNA set up for calibration. Continue?")
 
 
-def wait_for_complete(vna, attempt=1, max_attempts=20):
-    """
-    Wait a long time for the synchronization bit.
+def wait_for_complete(vna, timeout=600, poll_interval=1e-3, max_interval=0.1):
+    """Wait until all pending operations (e.g. a triggered sweep) complete,
+    and return the time that took, in s.
+
+    Sends *OPC, which sets the OPC bit of the event status register once
+    the sweep is done, then polls *ESR? with an exponentially growing
+    interval (from `poll_interval` up to `max_interval` seconds). Unlike
+    a blocking *OPC? query, this returns as soon as the sweep ends instead
+    of being limited by the VISA timeout.
+
+    Raises TimeoutError after `timeout` seconds.
     """
-    try:
-        vna.complete
-    except VisaIOError:
-        if attempt == max_attempts:
-            raise
-        else:
-            wait_for_complete(vna, attempt=attempt + 1, max_attempts=max_attempts)
+    start = time.perf_counter()
+    vna.ask("*ESR?")  # reading clears the register
+    vna.write("*OPC")
+    interval = poll_interval
+    while not int(vna.ask("*ESR?")) & 1:  # bit 0: operation complete
+        elapsed = time.perf_counter() - start
+        if elapsed > timeout:
+            raise TimeoutError(f"VNA did not complete within {elapsed:.1f} s")
+        time.sleep(interval)
+        interval = min(2 * interval, max_interval)
+    return time.perf_counter() - start
 
 
 @monitor_vna_err_queue
 def init_measurement(vna):
+    vna = caching.cached(vna)
     ch = vna.channels[1]
     ch.visible_traces = 4
-    for i, (tr, parameter) in enumerate(
-        zip(ch.traces.values(), ["S11", "S12", "S21", "S22"])
-    ):
+    for i, (tr, parameter) in enumerate(zip(ch.traces.values(), S_PARAMETERS)):
         tr.parameter = parameter
 
 
 @monitor_vna_err_queue
-def measure_and_save_touchstone(vna, fname, averaging=10):
+def measure_network(vna, averaging=10, averaging_trigger=False):
+    """Measure all S-parameters, averaged over `averaging` sweeps, and
+    return an skrf.network.Network.
+
+    If `averaging_trigger`, the analyzer's averaging trigger function is
+    used: a single trigger runs all `averaging` sweeps on the instrument,
+    and we only wait once, for the final result. Otherwise each sweep is
+    triggered (and waited for) from python.
+
+    Settings that match the known instrument state are not re-sent (see
+    `measurement_tools.caching`).
+    """
+    vna = caching.cached(vna)
     init_measurement(vna)  # ensure we're measuring everything
     ch = vna.channels[1]
     ch.averages = averaging
     ch.averaging_enabled = True
     ch.trigger_continuous = False
     vna.trigger_source = "BUS"
+    vna.write(f":TRIG:AVER {'ON' if averaging_trigger else 'OFF'}")
     vna.abort()
     ch.restart_averaging()
-    for _ in range(averaging):
+    sweep_times = []
+    for _ in range(1 if averaging_trigger else averaging):
         ch.trigger_initiate()  # arm channel 1
         vna.trigger_single()  # send a trigger
-        wait_for_complete(vna)
-    network = measurement_tools.vna.construct_network(vna.ch_1)
+        sweep_times.append(wait_for_complete(vna))
+    log.debug(
+        f"{averaging} sweeps took {np.sum(sweep_times):.3f} s, settings "
+        f"cache: {caching.stats(vna)}"
+    )
+    return measurement_tools.vna.construct_network(vna.ch_1)
+
+
+def measure_and_save_touchstone(vna, fname, averaging=10, averaging_trigger=False):
+    """Measure all S-parameters (see `measure_network`) and save them to the
+    touchstone file `fname`."""
+    network = measure_network(
+        vna, averaging=averaging, averaging_trigger=averaging_trigger
+    )
     network.name = Path(fname).name
     network.write_touchstone(fname)
     return network
+
+
+def measure_batch(
+    vna, duts, averaging=10, averaging_trigger=False, prepare=None, max_pending=2
+):
+    """Measure many DUTs, writing the touchstone file of each DUT on a
+    background thread while the next one is measured.
+
+    Parameters:
+    ----------
+    duts: list of (name, fname) tuples.
+    prepare: optional callable, called with the DUT name before each
+      measurement, e.g. to prompt the user to connect it or to set a switch.
+    max_pending: number of measured networks that may wait to be written
+      before measuring blocks (backpressure if writing is the bottleneck).
+
+    Writer errors do not stop the batch. They are raised (as an IOError
+    listing all failed files) once every DUT has been measured.
+
+    Returns:
+    -------
+    list of skrf.network.Network, in the order of `duts`.
+    """
+    pending = queue.Queue(maxsize=max_pending)
+    errors = []
+
+    def writer():
+        while (item := pending.get()) is not None:
+            network, fname = item
+            try:
+                network.write_touchstone(fname)
+            except Exception as e:
+                errors.append((fname, e))
+
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    writer_thread.start()
+    networks = []
+    try:
+        for name, fname in duts:
+            if prepare is not None:
+                prepare(name)
+            network = measure_network(
+                vna, averaging=averaging, averaging_trigger=averaging_trigger
+            )
+            network.name = name
+            pending.put((network, fname))  # blocks if the writer is behind
+            networks.append(network)
+    finally:
+        pending.put(None)
+        writer_thread.join()
+    if errors:
+        raise IOError(
+            f"Failed to write {len(errors)} touchstone file(s): "
+            + ", ".join(f"{fname} ({e})" for fname, e in errors)
+        ) from errors[0][1]
+    return networks
@@ -0,0 +1,225 @@
+"""
+Compact waveform capture files (.mtw), as written by `tek_control`.
+
+Instead of float64 volts plus an explicit time row (`np.save` of
+(1 + nchannels, nsamples)), the raw ADC codes of each channel are stored as
+int8/int16 with their scaling, and the time axis as start + increment:
+1-2 bytes per sample instead of 8 * (1 + 1 / nchannels).
+
+Layout:
+- MAGIC (8 bytes), header length (uint64, little endian)
+- JSON header: x_zero, x_incr, nsamples, acquisition settings, and per
+  channel its name, dtype, scale, offset and data offset in the file.
+- One block of raw codes per channel, each aligned to ALIGNMENT bytes.
+
+volts = codes * scale + offset, time = x_zero + x_incr * index.
+
+The reader memory-maps the channel blocks, so opening a file is instant
+and only the samples that are used are read; floats are computed on demand.
+`open_waveforms` gives the same interface for legacy .npy files, so long
+captures of either format can be processed in chunks (see tek_plot).
+"""
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'MTWAVE\x00\x01'
+ALIGNMENT = 4096
+EXTENSION = '.mtw'
+
+
+def _align(n):
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+
+def write_waveforms(fname, wfms, settings=None):
+    """
+    Parameters:
+    ----------
+    fname: output file name, conventionally ending in .mtw.
+    wfms: list of `tek.Waveform` (sharing one time base), e.g. the values
+      of `tek.retrieve_all_waveforms`.
+    settings: dict of acquisition settings to store, e.g.
+      `tek.acquisition_settings`.
+    """
+    if len(wfms) == 0:
+        raise ValueError('No waveforms to write.')
+    nsamples = len(wfms[0])
+    channels = []
+    offset = 0  # relative to the first block, fixed up below
+    for k, wfm in enumerate(wfms):
+        if len(wfm) != nsamples:
+            raise ValueError('All waveforms need the same number of samples.')
+        channels.append({
+            'name': wfm.source if wfm.source is not None else f'CH{k + 1}',
+            'dtype': wfm.codes.dtype.str,
+            'scale': wfm.y_mult,
+            'offset': wfm.y_zero - wfm.y_off * wfm.y_mult,
+            'data_offset': offset,
+        })
+        offset = _align(offset + wfm.codes.nbytes)
+    header = {'version': 1, 'nsamples': nsamples, 'x_zero': wfms[0].x_zero,
+              'x_incr': wfms[0].x_incr, 'settings': settings or {},
+              'channels': channels}
+    # the header size depends on the data offsets: reserve enough room.
+    start = _align(len(MAGIC) + 8 + len(json.dumps(header).encode('utf-8'))
+                   + 20 * len(channels))
+    for channel in channels:
+        channel['data_offset'] += start
+    text = json.dumps(header).encode('utf-8')
+    assert len(MAGIC) + 8 + len(text) <= start
+    with open(fname, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(text)) + text)
+        for channel, wfm in zip(channels, wfms):
+            f.seek(channel['data_offset'])
+            f.write(memoryview(np.ascontiguousarray(wfm.codes)).cast('B'))
+
+
+class WaveformFile:
+    """
+    Reader of .mtw files.
+
+    Attributes:
+    ----------
+    channels: list of channel names, e.g. ['CH1', 'CH4'].
+    nsamples, x_zero, x_incr: time base.
+    settings: acquisition settings dict.
+    codes: {channel name: read-only memory-mapped np.array of ADC codes}.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f'{fname} is not a waveform (.mtw) file.')
+            length, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(length).decode('utf-8'))
+        self.header = header
+        self.nsamples = header['nsamples']
+        self.x_zero = header['x_zero']
+        self.x_incr = header['x_incr']
+        self.settings = header['settings']
+        self.channels = [c['name'] for c in header['channels']]
+        self._scaling = {c['name']: (c['scale'], c['offset'])
+                         for c in header['channels']}
+        self.codes = {
+            c['name']: np.memmap(fname, dtype=np.dtype(c['dtype']), mode='r',
+                                 offset=c['data_offset'],
+                                 shape=(self.nsamples,))
+            for c in header['channels']}
+
+    def __len__(self):
+        return self.nsamples
+
+    def voltage(self, channel, start=0, stop=None):
+        """
+        Samples [start:stop] of `channel` (name or index) in V, as float64.
+        Only that range is mapped and read from disk, so memory use is
+        bounded by the range size.
+        """
+        if isinstance(channel, int):
+            channel = self.channels[channel]
+        scale, offset = self._scaling[channel]
+        codes = self.codes[channel]
+        start, stop, _ = slice(start, stop).indices(self.nsamples)
+        out = np.empty(max(stop - start, 0))
+        if len(out) > 0:
+            out[:] = np.memmap(self.fname, dtype=codes.dtype, mode='r',
+                               offset=codes.offset
+                               + start * codes.dtype.itemsize,
+                               shape=(len(out),))
+        out *= scale
+        out += offset
+        return out
+
+    def time(self, start=0, stop=None):
+        """
+        Sample times [start:stop] in s.
+        """
+        start, stop, _ = slice(start, stop).indices(self.nsamples)
+        return self.x_zero + self.x_incr * np.arange(start, stop)
+
+    def to_array(self):
+        """
+        The legacy `tek_control` layout: (1 + nchannels, nsamples) float64
+        array of time and channel voltages. Loads everything in memory.
+        """
+        arr = np.empty((1 + len(self.channels), self.nsamples))
+        arr[0] = self.time()
+        for k, channel in enumerate(self.channels):
+            arr[k + 1] = self.voltage(channel)
+        return arr
+
+
+class NpyWaveformFile:
+    """
+    Legacy `tek_control` .npy file (time and channel voltage rows), with
+    the `WaveformFile` reading interface. Requested ranges are memory
+    mapped, not the whole file.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 \
+                if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            self._data_offset = f.tell()
+        if len(shape) != 2 or fortran_order:
+            raise ValueError(f'{fname}: expected a C-ordered '
+                             '(1 + nchannels, nsamples) array.')
+        self._dtype = dtype
+        self.nsamples = shape[1]
+        self.channels = [f'CH{k + 1}' for k in range(shape[0] - 1)]
+
+    def __len__(self):
+        return self.nsamples
+
+    def _read(self, row, start, stop):
+        start, stop, _ = slice(start, stop).indices(self.nsamples)
+        if stop <= start:
+            return np.empty(0)
+        offset = self._data_offset + \
+            (row * self.nsamples + start) * self._dtype.itemsize
+        return np.array(np.memmap(self.fname, dtype=self._dtype, mode='r',
+                                  offset=offset, shape=(stop - start,)),
+                        dtype=np.float64)
+
+    def voltage(self, channel, start=0, stop=None):
+        if not isinstance(channel, int):
+            channel = self.channels.index(channel)
+        return self._read(channel + 1, start, stop)
+
+    def time(self, start=0, stop=None):
+        return self._read(0, start, stop)
+
+
+def is_waveform_file(fname):
+    """
+    Whether `fname` is a .mtw file, by its leading bytes (`tek_control`
+    writes them under any name that does not end in .npy).
+    """
+    with open(fname, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def open_waveforms(fname):
+    """
+    WaveformFile or NpyWaveformFile, depending on the file contents.
+    """
+    if is_waveform_file(fname):
+        return WaveformFile(fname)
+    return NpyWaveformFile(fname)
+
+
+def load_array(fname):
+    """
+    (1 + nchannels, nsamples) array of time and channel voltages from a .npy
+    or .mtw file (detected by its contents).
+    """
+    if is_waveform_file(fname):
+        return WaveformFile(fname).to_array()
+    return np.load(fname)
@@ -4,15 +4,17 @@ Alec Vercruysse
 
 Factory functins for instruments with 3rd-party python APIs.
 TODO refactor, decorators?
-"""
 
-import pyvisa
+All factories share one pyvisa ResourceManager, and calling a factory for
+an instrument that is already open returns the open instrument (see
+measurement_tools.resources). Pass the instrument to `resources.release`
+when done with it to close it early; everything is closed at exit anyway.
+
+Each factory imports its instrument library when called, so e.g. using the
+scope does not import pymeasure.
+"""
 
-from measurement_tools import interact
-from ThorlabsPM100 import ThorlabsPM100
-from pymeasure.instruments.agilent import Agilent33500, AgilentE5062A
-from pymeasure.instruments.keysight import KeysightB2900A
-from tekscope import Oscilloscope, raw
+from measurement_tools import interact, resources
 
 
 def OpticalPowerMeter(name=None):
@@ -25,17 +27,37 @@ def OpticalPowerMeter(name=None):
     rm: pyvisa context manager object.
     name: pyvisa resource name, or none
     """
-    print("Connecting to Thorlabs PM100D:")
-    rm = pyvisa.ResourceManager()
-    if name is None:
-        name = interact.get_pyvisa_instr_ID(rm, mytype="OpticalPowerMeter")
-    inst = rm.open_resource(name)
-    pm = ThorlabsPM100(inst=inst)
-    print(f"Successfully connected to {pm.system.sensor.idn}")
-    return pm
-
+    from ThorlabsPM100 import ThorlabsPM100
 
-def Agilent33500BFnGen(name=None, **kwargs):
+    print("Connecting to Thorlabs PM100D:")
+    rm = resources.resource_manager()
+
+    def connect(name):
+        idn = None
+
+        def open_pm():
+            nonlocal idn
+            inst = rm.open_resource(name)
+            try:
+                idn = inst.query("*IDN?").strip()
+            except Exception:
+                inst.close()
+                raise
+            return ThorlabsPM100(inst=inst), inst.close
+
+        pm, new = resources.acquire(("OpticalPowerMeter", name), open_pm)
+        if new:
+            print(f"Successfully connected to {pm.system.sensor.idn}")
+        else:
+            print(f"Reusing open connection to {name}")
+        return pm, idn
+
+    return interact.connect_instr(
+        rm, "OpticalPowerMeter", connect, name=name, disconnect=resources.release
+    )[0]
+
+
+def Agilent33500BFnGen(name=None, cached=False, **kwargs):
     """
     Factory function to return the Agilent33500 class with similar
     interactivity as other drivers.
@@ -44,17 +66,17 @@ def Agilent33500BFnGen(name=None, **kwargs):
     ----------
     rm: pyvisa context manager object.
     name: pyvisa resource name, or none
+    cached: return a caching proxy that drops writes of unchanged settings
+      (see measurement_tools.caching).
     """
+    from pymeasure.instruments.agilent import Agilent33500
+
     print("Connecting to Agilent 33500 Function Generator:")
-    rm = pyvisa.ResourceManager()
-    if name is None:
-        name = interact.get_pyvisa_instr_ID(rm, mytype="Agilent33500")
-    fngen = Agilent33500(name, **kwargs)
-    print(f"Successfully connected to {fngen.ask('*IDN?')}")
-    return fngen
+    fngen = _connect_pymeasure(Agilent33500, name, "Agilent33500", **kwargs)
+    return _cached(fngen) if cached else fngen
 
 
-def AgilentE5062AVNA(name=None, **kwargs):
+def AgilentE5062AVNA(name=None, cached=False, **kwargs):
     """
     Factory function to return the AgilentE5062A class with similar
     interactivity as other drivers.
@@ -63,14 +85,14 @@ def AgilentE5062AVNA(name=None, **kwargs):
     ----------
     rm: pyvisa context manager object.
     name: pyvisa resource name, or none
+    cached: return a caching proxy that drops writes of unchanged settings
+      (see measurement_tools.caching).
     """
+    from pymeasure.instruments.agilent import AgilentE5062A
+
     print("Connecting to Agilent E5602A VNA:")
-    rm = pyvisa.ResourceManager()
-    if name is None:
-        name = interact.get_pyvisa_instr_ID(rm, mytype="AgilentE5602A")
-    vna = AgilentE5062A(name, **kwargs)
-    print(f"Successfully connected to {vna.ask('*IDN?')}")
-    return vna
+    vna = _connect_pymeasure(AgilentE5062A, name, "AgilentE5602A", **kwargs)
+    return _cached(vna) if cached else vna
 
 
 def TekScope(host_id="169.254.8.194"):
@@ -82,15 +104,25 @@ def TekScope(host_id="169.254.8.194"):
     need to connect with ethernet cable, and somehow have the scope
     automatically pick it's own IP address.
     """
+    from tekscope import Oscilloscope, raw
+
     print("Connecting to Tektronix Oscilloscope:")
-    scope = Oscilloscope(host=host_id)
-    scope.send_raw_command("*IDN?")
-    resp = raw.query_ascii(scope.soc).decode("ascii")
-    print(f"Successfully connected to {resp}")
+
+    def connect():
+        scope = Oscilloscope(host=host_id)
+        return scope, scope.soc.close
+
+    scope, new = resources.acquire(("TekScope", host_id), connect)
+    if new:
+        scope.send_raw_command("*IDN?")
+        resp = raw.query_ascii(scope.soc).decode("ascii")
+        print(f"Successfully connected to {resp}")
+    else:
+        print(f"Reusing open connection to {host_id}")
     return scope
 
 
-def PSMU(name=None, **kwargs):
+def PSMU(name=None, cached=False, **kwargs):
     """Factory function to return the KeysightB2900A class with similar
     interactivity as other drivers.
 
@@ -98,12 +130,48 @@ def PSMU(name=None, **kwargs):
     ----------
     rm: pyvisa context manager object.
     name: pyvisa resource name, or none
+    cached: return a caching proxy that drops writes of unchanged settings
+      (see measurement_tools.caching).
 
     """
+    from pymeasure.instruments.keysight import KeysightB2900A
+
     print("Connecting to Keysight B2912A PSMU:")
-    rm = pyvisa.ResourceManager()
-    if name is None:
-        name = interact.get_pyvisa_instr_ID(rm, mytype="KeysightB2912A")
-    vna = KeysightB2900A(name, **kwargs)
-    print(f"Successfully connected to {vna.ask('*IDN?')}")
-    return vna
+    vna = _connect_pymeasure(KeysightB2900A, name, "KeysightB2912A", **kwargs)
+    return _cached(vna) if cached else vna
+
+
+def _cached(instr):
+    from measurement_tools import caching
+
+    return caching.cached(instr)
+
+
+def _connect_pymeasure(cls, name, mytype, **kwargs):
+    """
+    Open (or reuse) a pymeasure instrument of class `cls`, using the shared
+    VISA library. Prompts for the resource name if `name` is None.
+    """
+    rm = resources.resource_manager()
+    kwargs.setdefault("visa_library", rm.visa_lib)
+
+    def connect(name):
+        def open_instr():
+            instr = cls(name, **kwargs)
+            return instr, instr.adapter.close
+
+        instr, new = resources.acquire((cls.__name__, name), open_instr)
+        if not new:
+            print(f"Reusing open connection to {name}")
+            return instr, None
+        try:
+            idn = instr.ask("*IDN?").strip()
+        except Exception:
+            resources.release(instr)
+            raise
+        print(f"Successfully connected to {idn}")
+        return instr, idn
+
+    return interact.connect_instr(
+        rm, mytype, connect, name=name, disconnect=resources.release
+    )[0]
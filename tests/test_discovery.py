@@ -0,0 +1,46 @@
+from measurement_tools import discovery
+
+LAN = 'TCPIP::192.168.2.233::INSTR'
+USB_1 = 'USB0::0x1313::0x8078::P0000001::INSTR'
+USB_2 = 'USB0::0x1313::0x8078::P0000002::INSTR'
+
+
+class StandInRM:
+    def __init__(self, resources):
+        self.resources = resources
+        self.scans = 0
+
+    def list_resources(self):
+        self.scans += 1
+        return tuple(self.resources)
+
+
+def test_live_visa_with_cached_lan(tmp_path, monkeypatch):
+    monkeypatch.setattr(discovery, 'browse_mdns', lambda **kwargs: {LAN})
+    cache_file = str(tmp_path / 'discovery')
+    rm = StandInRM([USB_1])
+    kwargs = {'cache_file': cache_file, 'hosts': []}
+
+    assert discovery.list_resources(rm, live_visa=True, **kwargs) == \
+        sorted([LAN, USB_1])
+    assert rm.scans == 1
+
+    # USB_1 unplugged, USB_2 plugged in, within the cache TTL.
+    rm.resources = [USB_2]
+    monkeypatch.setattr(discovery, 'browse_mdns', lambda **kwargs: set())
+    assert discovery.list_resources(rm, live_visa=True, **kwargs) == \
+        sorted([LAN, USB_2])
+    assert rm.scans == 2
+    # without live_visa, everything comes from the cache.
+    assert discovery.list_resources(rm, **kwargs) == sorted([LAN, USB_1])
+    assert rm.scans == 2
+
+
+def test_old_cache_format_is_rediscovered(tmp_path, monkeypatch):
+    monkeypatch.setattr(discovery, 'browse_mdns', lambda **kwargs: {LAN})
+    cache_file = tmp_path / 'discovery'
+    cache_file.write_text('{"timestamp": 1e12, "resources": []}')
+    rm = StandInRM([USB_1])
+    assert discovery.list_resources(rm, live_visa=True, hosts=[],
+                                    cache_file=str(cache_file)) == \
+        sorted([LAN, USB_1])
@@ -0,0 +1,54 @@
+"""
+The package and the entry points that are fast to start must not import the
+instrument / analysis libraries at startup (see the lazy imports in
+measurement_tools/__init__.py and wrappers.py). benchmarks/bench_import.py
+also times them.
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'src')
+
+HEAVY = ['pyvisa', 'pymeasure', 'ThorlabsPM100', 'tekscope', 'skrf',
+         'pandas', 'matplotlib', 'zeroconf']
+
+# module -> heavy libraries it may import
+MODULES = {
+    'measurement_tools': [],
+    'measurement_tools.scripts.pyvisa_list': [],
+    'measurement_tools.scripts.tek_plot': ['matplotlib'],
+    'measurement_tools.scripts.tek_control': [],
+    'measurement_tools.scripts.laser_control': [],
+    'measurement_tools.scripts.agilent33500b_control': [],
+    'measurement_tools.scripts.instrument_server': [],
+}
+
+
+def imported(module):
+    """
+    (top-level packages in sys.modules after `import module` in a fresh
+    interpreter, its -X importtime report).
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [SRC] + [p for p in [env.get('PYTHONPATH')] if p])
+    code = (f'import sys, json, {module}; '
+            'print(json.dumps(sorted({m.split(".")[0] '
+            'for m in sys.modules})))')
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          capture_output=True, text=True, env=env)
+    assert proc.returncode == 0, proc.stderr.splitlines()[-1]
+    return set(json.loads(proc.stdout)), proc.stderr
+
+
+@pytest.mark.parametrize('module', list(MODULES))
+def test_no_heavy_imports(module):
+    modules, report = imported(module)
+    heavy = [m for m in HEAVY if m in modules and m not in MODULES[module]]
+    chains = [line for line in report.splitlines()
+              if any(line.rstrip().endswith(f' {m}') for m in heavy)]
+    assert heavy == [], f'{module} imports {heavy}:\n' + '\n'.join(chains)
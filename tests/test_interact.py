@@ -0,0 +1,61 @@
+import json
+
+from measurement_tools import interact
+
+LASER = 'ASRL/dev/ttyUSB0::INSTR'
+OTHER_SERIAL = 'ASRL/dev/ttyUSB1::INSTR'
+METER = 'USB0::0x1313::0x8078::P0000001::INSTR'
+FN_GEN = 'USB0::0x0957::0x2807::MY00000001::INSTR'
+IDNS = {
+    LASER: 'Arroyo,4304,000001,1.0',
+    OTHER_SERIAL: None,
+    METER: 'Thorlabs,PM100USB,P0000001,1.0',
+    FN_GEN: 'Agilent Technologies,33522B,MY00000001,1.0',
+}
+
+
+class StandInInstr:
+    def __init__(self, rm, resource):
+        self.rm = rm
+        self.resource = resource
+
+    def query(self, command):
+        self.rm.probed.append(self.resource)
+        if IDNS[self.resource] is None:
+            raise TimeoutError
+        return IDNS[self.resource]
+
+    def close(self):
+        pass
+
+
+class StandInRM:
+    def __init__(self):
+        self.probed = []
+
+    def list_resources(self):
+        return tuple(IDNS)
+
+    def list_opened_resources(self):
+        return []
+
+    def open_resource(self, resource, **kwargs):
+        return StandInInstr(self, resource)
+
+
+def test_auto_identify_skips_serial_and_other_types(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(interact, 'list_resources',
+                        lambda rm, refresh=False: rm.list_resources())
+    (tmp_path / '.measurement_tools').write_text(json.dumps(
+        {'Agilent33500': {'resource': FN_GEN, 'idn': IDNS[FN_GEN],
+                          'serial': 'MY00000001'}}))
+    rm = StandInRM()
+    found = interact.auto_identify_instr(rm, 'OpticalPowerMeter')
+    assert found['resource'] == METER
+    assert set(rm.probed) == {METER}
+
+    rm = StandInRM()
+    found = interact.auto_identify_instr(rm, 'LaserDriver')
+    assert found['resource'] == LASER
+    assert set(rm.probed) == {LASER, OTHER_SERIAL, METER}
@@ -0,0 +1,32 @@
+import os
+
+from measurement_tools import results
+
+
+def write_run(fname, laserid, run, npoints):
+    with results.ResultWriter(fname, laserid, run=run, fsync=False) as w:
+        for k in range(npoints):
+            w.append(mA=k, V=1. + k, mW=float('nan'))
+
+
+def test_export_run(tmp_path):
+    log = str(tmp_path / 'log.jsonl')
+    write_run(log, 'laser1', 'run1', 3)
+    write_run(log, 'laser2', 'run2', 2)
+    out = str(tmp_path / 'out.csv')
+    df = results.export_results(log, out, run='run2')
+    assert list(df.columns) == ['laser2_mA', 'laser2_V', 'laser2_mW']
+    assert list(df['laser2_mA']) == [0, 1]
+    assert os.path.exists(out)
+
+
+def test_export_unknown_or_empty_run(tmp_path):
+    log = str(tmp_path / 'log.jsonl')
+    write_run(log, 'laser1', 'run1', 3)
+    write_run(log, 'laser1', 'aborted', 0)  # no point before the abort
+    out = str(tmp_path / 'out.csv')
+    for run in ['unknown', 'aborted']:
+        df = results.export_results(log, out, run=run)
+        assert len(df) == 0 and len(df.columns) == 0
+    assert len(results.export_results(log, out, laserid='nobody')) == 0
+    assert not os.path.exists(out)
@@ -0,0 +1,52 @@
+import math
+
+from measurement_tools import tek
+
+
+class StubSocket:
+    """
+    Answers the scope queries `tek` sends, with headers on until
+    'HEADer OFF' (like a scope after *RST).
+    """
+
+    def __init__(self, value='1.23E-1'):
+        self.value = value
+        self.header = True
+        self.commands = []
+        self.replies = []
+
+    def sendall(self, data):
+        command = data.decode('ascii').strip()
+        self.commands.append(command)
+        upper = command.upper()
+        if upper == 'HEADER OFF':
+            self.header = False
+        elif upper.startswith('MEASUREMENT:MEAS1:VALUE?'):
+            header = ':MEASUREMENT:MEAS1:VALUE ' if self.header else ''
+            self.replies.append(f'{header}{self.value}\n'.encode('ascii'))
+
+    def recv(self, n):
+        return self.replies.pop(0)
+
+
+class StubScope:
+    def __init__(self, **kwargs):
+        self.soc = StubSocket(**kwargs)
+
+
+def test_gated_mean_after_reset_turns_headers_off():
+    scope = StubScope()
+    tek.setup_gated_mean(scope, 'CH4', 0, 50e-3)
+    assert not scope.soc.header
+    assert tek.read_measurement(scope) == 0.123
+
+
+def test_read_measurement_with_headers_on():
+    scope = StubScope()
+    assert tek.read_measurement(scope) == 0.123
+
+
+def test_read_measurement_without_trigger():
+    scope = StubScope(value='9.9E37')
+    tek.setup_gated_mean(scope)
+    assert math.isnan(tek.read_measurement(scope))